@@ -0,0 +1,101 @@
+"""
+    Benchmark the hot paths of the filament tools on synthetic snapshots
+    (see src/synthetic_snapshot.py) of different numbers of particles and
+    centres: catalogue loading, readout volumes, particle selection, dumping
+    and histogramming. For every stage the wall time, the throughput and
+    the peak resident memory are printed and written as json lines.
+
+    Usage: python benchmark.py [--particles 100000,1000000] [--centres 100,1000]
+                               [--box-length 0.5] [--max-memory BYTES]
+                               [--workdir benchmark_data] [--output benchmark.jsonl]
+"""
+import os
+import json
+import time
+import argparse
+from src.filament_extractor import *
+from src.synthetic_snapshot import make_snapshot, make_catalogue
+from src.instrumentation import peak_rss, reset_peak
+
+attributes = ['Density', 'Temperature', 'StarFormationRate', 'Mass']
+
+def measure(results, config, stage, function, items):
+    """
+        Run function, record the time and peak memory of stage,
+        items: number of particles or centres processed, for the throughput
+    """
+    reset_peak()
+    start = time.time()
+    value = function()
+    seconds = time.time() - start
+    result = dict(config)
+    result.update({'stage': stage, 'seconds': seconds, 'items': items,
+                   'throughput': items/seconds if seconds > 0 else None,
+                   'peak_rss': peak_rss()})
+    results.append(result)
+    print "{:>16} {:>10.3f} s {:>12.3g} /s {:>8.1f} MB".format(stage, seconds,
+        result['throughput'] or 0, result['peak_rss']/2.**20)
+    return value
+
+def run(nparticles, ncentres, args, results):
+    prefix = os.path.join(args.workdir, 'snap_{}'.format(nparticles))
+    if not os.path.isfile(prefix + '.0.hdf5'):
+        print "Writing synthetic snapshot", prefix, "..."
+        make_snapshot(prefix, nparticles)
+    csv = '{}_{}.csv'.format(prefix, ncentres)
+    make_catalogue(csv, prefix, ncentres)
+
+    config = {'particles': nparticles, 'centres': ncentres, 'box_length': args.box_length,
+              'max_memory': args.max_memory}
+    print ""
+    print "{} particles, {} centres".format(nparticles, ncentres)
+
+    # Parsing the csv (sidecar written) and loading the binary sidecar
+    catalogue = CatalogueReader(csv)
+    measure(results, config, 'catalogue_parse', catalogue.load, ncentres)
+    measure(results, config, 'catalogue_load', catalogue.load, ncentres)
+
+    fil = measure(results, config, 'filaments',
+                  lambda: Filaments(list(attributes), catalogue, args.box_length, max_memory=args.max_memory),
+                  nparticles)
+    measure(results, config, 'readout_volumes', lambda: fil.get_readout_volumes(args.box_length), ncentres)
+
+    # Select again, the index of the first selection must be dropped for that
+    def select():
+        fil._index = None
+        fil.read_particles()
+    measure(results, config, 'read_particles', select, nparticles)
+
+    nselected = fil.data()['Coordinates'].shape[0]
+    measure(results, config, 'load_attributes', lambda: fil.data().load(attributes), nselected)
+    measure(results, config, 'dump_hdf5', lambda: fil.dump(os.path.join(args.workdir, 'dump.hdf5')), nselected)
+    measure(results, config, 'dump_csv', lambda: fil.dump(os.path.join(args.workdir, 'dump.csv')), nselected)
+    measure(results, config, 'histogram', lambda: fil.histogram('Density', -32, -22, weights='Mass'), nselected)
+    measure(results, config, 'phase_diagram', lambda: fil.phase_diagram('Mass'), nselected)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the filament tools on synthetic snapshots.")
+    parser.add_argument('--particles', default='100000,1000000',
+                        help="comma separated numbers of gas particles")
+    parser.add_argument('--centres', default='100,1000',
+                        help="comma separated numbers of centres")
+    parser.add_argument('--box-length', type=float, default=0.5)
+    parser.add_argument('--max-memory', type=int, default=None,
+                        help="stream the snapshot with this many bytes")
+    parser.add_argument('--workdir', default='benchmark_data')
+    parser.add_argument('--output', default='benchmark.jsonl')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+
+    results = []
+    for nparticles in [int(float(n)) for n in args.particles.split(',')]:
+        for ncentres in [int(float(n)) for n in args.centres.split(',')]:
+            run(nparticles, ncentres, args, results)
+
+    with open(args.output, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+    print ""
+    print "Results appended to", args.output
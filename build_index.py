@@ -0,0 +1,30 @@
+"""
+    Build the persistent particle index of a snapshot (see
+    src/particle_index.py), once per snapshot. Afterwards
+    Filaments(..., particle_index=True) reads only the particles in the
+    cells touched by the filament instead of all coordinates.
+
+    Usage: python build_index.py snapshot.0.hdf5 [part_types] [ncells] [directory]
+           e.g. python build_index.py snap_012_z003p017.0.hdf5 0,1 64 /scratch/index
+           directory: where to write the index (8 bytes per particle),
+                      default: the cache directory, see snapshot_metadata.py
+           then use Filaments(..., particle_index='/scratch/index')
+"""
+import sys
+import time
+from src.particle_index import ParticleIndex
+from src.snapshot_metadata import CACHE_DIR
+
+if len(sys.argv) < 2:
+    print "Usage: python build_index.py snapshot.0.hdf5 [part_types] [ncells] [directory]"
+    sys.exit(1)
+
+dataloc = sys.argv[1]
+part_types = [int(t) for t in sys.argv[2].split(',')] if len(sys.argv) > 2 else [0]
+ncells = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+directory = sys.argv[4] if len(sys.argv) > 4 else CACHE_DIR
+
+for itype in part_types:
+    start = time.time()
+    path = ParticleIndex.build(dataloc, itype, ncells, directory)
+    print "Index of PartType{} written to {} ({:.1f} s).".format(itype, path, time.time() - start)
@@ -0,0 +1,29 @@
+"""
+    Extract the particles near all centres of a filament catalogue at once
+    and dump them. The snapshot is read only once and the selection is split
+    among several processes, which replaces the loop over catalogue slices
+    in run.sh.
+
+    Usage: python driver.py catalogue.csv box_length processes outfile [append]
+           append: append to an existing hdf5 dump instead of overwriting it
+"""
+import sys
+from src.filament_extractor import *
+
+attributes = ['Density', 'Temperature', 'StarFormationRate']
+
+if len(sys.argv) < 5:
+    print "Usage: python driver.py catalogue.csv box_length processes outfile [append]"
+    sys.exit(1)
+
+catalogue = CatalogueReader(sys.argv[1])
+box_length = float(sys.argv[2])
+processes = int(sys.argv[3])
+outfile = sys.argv[4]
+append = len(sys.argv) > 5 and sys.argv[5] == 'append'
+
+# Pass a copy, Filaments adds the coordinates to the attributes
+fil = Filaments(list(attributes), catalogue, box_length, processes=processes)
+
+# Dump with the conversion factors and the header of the selection
+fil.dump(outfile, append=append)
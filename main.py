@@ -4,6 +4,8 @@ from src.visualiser import *
 
 attributes = ['Density', 'Temperature', 'StarFormationRate']
 catalogue = CatalogueReader("FILAMENT_CATALOGUE/s12.csv")
+# Reuse particle selections of previous runs
+cache = SelectionCache("selection_cache")
 
 # If indices for catalogue data is given define it!
 # Use to parallelise data loading
@@ -18,7 +20,7 @@ targets = ["Test"]
 if "Test" in targets:
     region_length = 0.5 # small test region
     catalogue_index = np.arange(10) # need only one location
-    fil = Filaments(attributes, catalogue, region_length, catalogue_index)
+    fil = Filaments(attributes, catalogue, region_length, catalogue_index, cache=cache)
 
     data = fil.data()
 
@@ -39,7 +41,7 @@ if "Filament" in targets:
     # Filament
     region_length = 1
 
-    fil = Filaments(attributes, catalogue, region_length)
+    fil = Filaments(attributes, catalogue, region_length, cache=cache)
 
     # Plot
     fil.hist('Density', title='Density histogram, RL = ' + str(region_length))
@@ -55,27 +57,37 @@ if "Full" in targets:
     fil.hist('Temperature', title='Temperature histogram, RL = ' + str(region_length), saveas="_hist_full.png")
 
 if "Combined" in targets:
-    # Filament
-    fil01 = Filaments(attributes, catalogue, region_length=0.1)
-    fil02 = Filaments(attributes, catalogue, region_length=0.2)
-    fil05 = Filaments(attributes, catalogue, region_length=0.5)
-    fil08 = Filaments(attributes, catalogue, region_length=0.8)
-    fil1 = Filaments(attributes, catalogue, region_length=1)
-    fil2 = Filaments(attributes, catalogue, region_length=2)
-    all = Filaments(attributes, catalogue, region_length=25, catalogue_index=0)
-
-    filaments = [all, fil2, fil1, fil08, fil05, fil02, fil01]
+    # Filament, all smaller box lengths are taken from the largest one
+    fil = Filaments(attributes, catalogue, box_length=2, cache=cache)
+    all = Filaments(attributes, catalogue, box_length=25, catalogue_index=0, cache=cache)
+
+    filaments = [all] + fil.scales([2, 1, 0.8, 0.5, 0.2, 0.1])
     label = ["Full cube (25 Mpc)", "2 Mpc", "1 Mpc", "0.8 Mpc", "0.5 Mpc", "0.2 Mpc", "0.1 Mpc"]
 
     screen = Visualiser()
     screen.hist(filaments, 'Density', title="Different cube sizes", labels=label, saveas="_hist_compare.png")
     screen.hist(filaments, 'Temperature', title="Different cube sizes", labels=label, saveas="_hist_compare.png")
 
+if "Partial" in targets:
+    # Partial histograms of this slice of the catalogue (e.g. from run.sh),
+    # add them up with sum(Histogram.load(f) for f in files) and plot the
+    # sum with Visualiser().hist
+    fil = Filaments(attributes, catalogue, box_length=1, catalogue_index=catalogue_index, cache=cache)
+    shard = np.min(catalogue_index)
+    fil.histogram('Density', -32, -22).save("Density_hist.{}.npz".format(shard))
+    fil.histogram('Temperature', 2, 8).save("Temperature_hist.{}.npz".format(shard))
+
 if "Baryon" in targets:
     baryon_ctlg = CatalogueReader("/scratch/jgacon/DisPerSE/EAGLE/BARYONS/REFL0012N0188/FILAMENT/s3_baryons.csv")
-    fil = Filaments(attributes, baryon_ctlg, region_length=0.01, catalogue_index=catalogue_index)
+    fil = Filaments(attributes, baryon_ctlg, box_length=0.01, catalogue_index=catalogue_index, cache=cache)
 
     #fil.dump("fil.{}.dump".format(catalogue_index[0]))
 
     #screen = Visualiser()
     #screen.hist(fil, 'Density', title='Baryonic filaments', saveas="_hist_bary.png")
+
+if "DarkMatter" in targets:
+    # Gas and dark matter near the same filament, selected in one pass
+    fil = Filaments(['Mass'], catalogue, box_length=1, cache=cache, part_type=[0, 1])
+    gas, dm = fil.data()[0]['Mass'], fil.data()[1]['Mass']
+    print "Baryon fraction (gas only):", gas.sum()/(gas.sum() + dm.sum())
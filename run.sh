@@ -1,5 +1,8 @@
 #! /bin/bash
 
+# Runs main.py for one slice of the catalogue after the other,
+# see driver.py to process the whole catalogue in parallel at once
+
 # how many filament centres are being processed at once
 stepsize=50000
 # Galaxy catalogue
@@ -7,7 +10,7 @@ stepsize=50000
 # Baryon catalogue
 filament_catalogue="/scratch/jgacon/DisPerSE/EAGLE/BARYONS/REFL0012N0188/FILAMENT/s3_baryons.csv"
 ncentres=$(wc -l < $filament_catalogue)
-ncentres=$(expr $ncentres - 2)
+ncentres=$(expr $ncentres - 5) # 4 commentary lines and the header
 
 echo "Number of centres: $ncentres"
 echo "Stepsize: $stepsize"
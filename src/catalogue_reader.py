@@ -1,5 +1,9 @@
+import os
+import json
+from itertools import islice
 import numpy as np
-import h5py # for header_info
+
+from snapshot_metadata import SnapshotMetadata # for header_info
 
 """
     About the structure of the filament catalogues:
@@ -19,19 +23,50 @@ import h5py # for header_info
     data, we only read out the last 3 columns. Of course the catalogue can
     only contain 3 columns (the coordinates), but in case more data is
     supposed to be saved this is possible.
+
+    Parsing the csv file is slow, therefore it is converted once to a binary
+    sidecar next to it:
+        catalogue.csv.npy  -> all columns as float64, memory-mapped on use
+        catalogue.csv.json -> column names and modification time of the csv
+    If the csv is modified the sidecar is written again. If it cannot be
+    written (e.g. read-only directory) the parsed csv is kept in memory.
+
+    load and iter_chunks read only the columns they need and can drop
+    centres with a filter on the other columns, e.g.
+        reader.load(where=[('persistence_nsigmas', '>', 3)])
+    returns the coordinates of the centres with persistence_nsigmas > 3,
+    the other centres and columns are never copied out of the sidecar
+    (or parsed from the csv).
 """
 
+# Comparisons allowed in filters (column, op, value)
+OPERATORS = {
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '==': np.equal,
+    '!=': np.not_equal,
+}
+
 class CatalogueReader:
 
-    def __init__(self, fname, delim=","):
+    def __init__(self, fname, delim=",", sidecar=True, where=None):
         """
             fname = filename of catalogue, csv file format
             has_header = does the csv file have a header?
             delim = delimiter in csv
+            sidecar = use the binary sidecar (True) or parse the csv on
+                      every load (False)
+            where = default filter of load and iter_chunks, list of
+                    (column, op, value), see filter
         """
         self._fname = fname
         self._delim = delim
+        self._sidecar = sidecar
+        self._where = where
         self._data = None
+        self._table = None # will be set by table
 
         # extract location of EAGLE data
         # e.g. /net/astrogate/export/astrodata/EAGLE_snapshots/RefL0025N0376/snap_012_z003p017.0.hdf5
@@ -41,6 +76,10 @@ class CatalogueReader:
             self._cube_length = float(f.readline().strip('# \n'))
             self._num_particles = int(f.readline().strip('# \n'))
             self._metadata = f.readline().strip('# \n')
+            self._colnames = [c.strip(' "\n') for c in f.readline().split(self._delim)]
+
+    def fname(self):
+        return self._fname
 
     def snap_loc(self):
         return self._dataloc
@@ -64,47 +103,244 @@ class CatalogueReader:
         """
         return self._metadata
 
+    def colnames(self):
+        return self._colnames
+
+    def column_index(self, column):
+        """
+            Index of a column given by its name or index
+            (negative indices count from the last column)
+        """
+        if isinstance(column, basestring):
+            if not column in self._colnames:
+                raise KeyError("No column {} in {}, only {}.".format(column, self._fname, self._colnames))
+            return self._colnames.index(column)
+        return range(len(self._colnames))[column]
+
+    def projection(self, columns=None, where=None):
+        """
+            Indices of the requested columns (default: the coordinates, i.e.
+            the last 3 columns) and of all columns to read, i.e. including
+            the ones the filter needs
+        """
+        if columns is None:
+            columns = [-3, -2, -1]
+        columns = [self.column_index(c) for c in columns]
+        needed = set(columns)
+        for column, op, value in where or []:
+            needed.add(self.column_index(column))
+        return columns, sorted(needed)
+
+    def filter(self, data, usecols, where=None):
+        """
+            Mask of the rows of data which pass all conditions of where,
+            a list of (column, op, value), e.g.
+                [('persistence_nsigmas', '>', 3), ('persistence_ratio', '<=', 5)]
+            op is one of <, <=, >, >=, ==, !=.
+            usecols: index in the catalogue of every column of data
+        """
+        mask = np.ones(data.shape[0], dtype=bool)
+        for column, op, value in where or []:
+            if not op in OPERATORS:
+                raise ValueError("Unknown operator {}, use one of {}.".format(op, sorted(OPERATORS)))
+            values = data[:, usecols.index(self.column_index(column))]
+            mask &= OPERATORS[op](values, value)
+        return mask
+
+    def select(self, data, columns, usecols, where=None):
+        """
+            Requested columns of the rows of data passing the filter
+        """
+        take = [usecols.index(c) for c in columns]
+        if not where:
+            return data[:, take]
+        mask = self.filter(data, usecols, where)
+        return data[mask][:, take]
+
     def num_centres(self):
-        # minus 2 since first line is location of the snapshot and
-        # second is the rownames
-        return sum(1 for line in open(self._fname)) - 2
+        """
+            Number of rows of the catalogue, the filter (where) is not
+            applied, load may return fewer centres
+        """
+        if self._sidecar:
+            return self.table().shape[0]
+
+        # minus 5 since the first 4 lines are commentary and
+        # the fifth are the rownames
+        return sum(1 for line in open(self._fname)) - 5
+
+    def table(self, block_size=2**16):
+        """
+            All columns of the catalogue, shape (ncentres, ncolumns),
+            memory-mapped from the binary sidecar, which is (re)written
+            if it is missing or older than the csv.
+            block_size: number of lines of the csv parsed at once when
+                        the sidecar is written
+        """
+        if self._table is not None:
+            return self._table
+
+        npy, meta = self._fname + '.npy', self._fname + '.json'
+        mtime = os.path.getmtime(self._fname)
+
+        # Up to date sidecar?
+        if os.path.isfile(npy) and os.path.isfile(meta):
+            with open(meta, 'r') as f:
+                info = json.load(f)
+            if info.get('mtime') == mtime:
+                self._table = np.load(npy, mmap_mode='r')
+                return self._table
+
+        print "Converting", self._fname, "to binary sidecar ..."
+        shape = (self.num_rows(), len(self._colnames))
+
+        # Parsed in blocks straight into the memory-mapped sidecar, the
+        # whole csv is never in memory. Written to temporary files first,
+        # other processes might read the sidecar at the same time
+        tmp = '{}.{}.tmp'.format(npy, os.getpid())
+        try:
+            data = np.lib.format.open_memmap(tmp, mode='w+', dtype='f8', shape=shape)
+        except (IOError, OSError):
+            print "Could not write sidecar, keeping the catalogue in memory."
+            tmp = None
+            data = np.empty(shape)
+
+        row = 0
+        for block in self.parse_blocks(block_size):
+            data[row:row+block.shape[0]] = block
+            row += block.shape[0]
+
+        if tmp is None:
+            self._table = data
+            return self._table
+
+        data.flush()
+        self._table = data
+        try:
+            os.rename(tmp, npy)
+            tmpmeta = '{}.{}.tmp'.format(meta, os.getpid())
+            with open(tmpmeta, 'w') as f:
+                json.dump({'mtime': mtime, 'colnames': self._colnames}, f)
+            os.rename(tmpmeta, meta)
+            self._table = np.load(npy, mmap_mode='r')
+        except (IOError, OSError):
+            print "Could not write sidecar, keeping the catalogue in memory."
+            self._table = np.array(self._table)
+
+        return self._table
+
+    def iter_chunks(self, chunk_size, columns=None, where=None):
+        """
+            Generator over blocks of at most chunk_size consecutive centres,
+            the catalogue is read only once, from front to back.
+            Yields (offset, centres) where offset is the first row of the
+            block (first row = 0), centres has shape (n, 3). Blocks without
+            any centre passing the filter are skipped.
+            columns: names or indices of the columns to return,
+                     default: the coordinates
+            where: filter, the rows failing it are dropped from every block,
+                   default: the filter given to the constructor (see filter)
+        """
+        if where is None:
+            where = self._where
+        columns, usecols = self.projection(columns, where)
+
+        if self._sidecar:
+            table = self.table()
+            for offset in range(0, table.shape[0], chunk_size):
+                # Only the needed columns of the block are copied
+                block = table[offset:offset+chunk_size][:, usecols]
+                block = self.select(block, columns, usecols, where)
+                if block.shape[0] > 0:
+                    yield offset, block
+            return
+
+        offset = 0
+        for data in self.parse_blocks(chunk_size, usecols):
+            block = self.select(data, columns, usecols, where)
+            if block.shape[0] > 0:
+                yield offset, block
+            offset += data.shape[0]
+
+    def parse_blocks(self, block_size, usecols=None):
+        """
+            Generator over the rows of the csv parsed in blocks of at most
+            block_size lines, shape (n, number of columns read), so only
+            one block is in memory at once.
+            usecols: indices of the columns to parse, default: all
+        """
+        ncols = len(self._colnames) if usecols is None else len(usecols)
+        with open(self._fname, 'r') as f:
+            # skip 4 (commentary) + 1 (header) lines
+            for i in range(5):
+                f.readline()
+
+            while True:
+                lines = list(islice(f, block_size))
+                if len(lines) == 0:
+                    break
+                data = np.genfromtxt(lines, delimiter=self._delim, usecols=usecols)
+                if data.size == 0:
+                    continue
+                # ensure 2d (matrix form)
+                yield data.reshape((-1, ncols))
+
+    def num_rows(self):
+        """
+            Number of rows of the csv, counted without parsing them
+            (blank lines and comments are skipped by genfromtxt as well)
+        """
+        with open(self._fname, 'r') as f:
+            for i in range(5):
+                f.readline()
+            return sum(1 for line in f if line.strip() and not line.lstrip().startswith('#'))
 
     def header_info(self):
         """
             Read various attributes from the header group.
+            Scale factor, h and box size L [Mph/h], see snapshot_metadata.py
         """
-        f = h5py.File(self._dataloc, 'r')
-        a = f['Header'].attrs.get('Time')         # Scale factor.
-        h = f['Header'].attrs.get('HubbleParam')  # h.
-        boxsize = f['Header'].attrs.get('BoxSize')      # L [Mph/h].
-        f.close()
+        return SnapshotMetadata.get(self._dataloc).header_info()
 
-        return a, h, boxsize
-
-    def load(self, startrow=0, endrow=None):
+    def load(self, startrow=0, endrow=None, columns=None, where=None):
         """
             read data and save to self._data and return it
             startrow: in which row to start reading the data (first row = 0)
             endrow: last row (0-based count)
+            columns: names or indices of the columns to return,
+                     default: the coordinates (last 3 columns)
+            where: filter, only the rows passing it are returned,
+                   default: the filter given to the constructor (see filter)
         """
-        # number of lines to skip: 4 (commentary) + 1 (header) = 5
-        skip = 5 + startrow
+        if where is None:
+            where = self._where
+        columns, usecols = self.projection(columns, where)
 
         print "Loading data from", self._fname,"..."
-        if endrow is None:
-            data = np.genfromtxt(self._fname, delimiter=self._delim, skip_header=skip)
+        if self._sidecar:
+            # Only the needed columns of the rows are copied
+            data = self.table()[startrow:endrow][:, usecols]
         else:
-            maxrows = endrow - startrow
-            data = np.genfromtxt(self._fname, delimiter=self._delim, skip_header=skip, max_rows=maxrows)
-        print "Loaded", data.shape[0], "particles."
+            # number of lines to skip: 4 (commentary) + 1 (header) = 5
+            skip = 5 + startrow
+
+            if endrow is None:
+                data = np.genfromtxt(self._fname, delimiter=self._delim, skip_header=skip, usecols=usecols)
+            else:
+                maxrows = endrow - startrow
+                data = np.genfromtxt(self._fname, delimiter=self._delim, skip_header=skip, max_rows=maxrows, usecols=usecols)
 
         # ensure 2d (matrix form)
-        if len(data.shape) == 1:
-            data = data.reshape((1, data.size))
+        data = data.reshape((-1, len(usecols)))
+        nrows = data.shape[0]
 
-        # extract last 3 columns (also valid if only 3 exist)
+        # extract the requested columns of the rows passing the filter
         # and save data
-        self._data = data[:,-3:]
+        self._data = self.select(data, columns, usecols, where)
+        if where:
+            print "Loaded", self._data.shape[0], "of", nrows, "particles passing", where
+        else:
+            print "Loaded", nrows, "particles."
 
         # return to user
         return self._data
@@ -0,0 +1,147 @@
+import numpy as np
+import h5py
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from snapshot_metadata import SnapshotMetadata
+
+"""
+    Read the files of an EAGLE snapshot into preallocated arrays.
+
+    The number of particles in every file (NumPart_ThisFile) is known from
+    the headers, so the output is allocated once and each file is read by a
+    thread of a pool directly into its slice, instead of reading the files
+    one after another and concatenating them at the end:
+
+        reader = ConcurrentReader('/path/to/snap_012_z003p017.0.hdf5')
+        density = reader.read_dataset(0, 'Density')
+
+    ConcurrentSnapshot has the interface of read_eagle.EagleSnapshot
+    (boxsize, select_region, clear_selection, read_dataset) for snapshots
+    without hash tables: the coordinates of all particles are read once per
+    particle type to find the ones in the selected regions. See
+    eagle_snapshot.py for the stand-in using the hash tables.
+
+    Note that h5py serialises all HDF5 calls, including read_direct and the
+    decompression of the data, with one global lock. The reads of the
+    threads therefore don't overlap, the files are still read one at a
+    time. What the threads overlap is the numpy work around the reads
+    (selecting the particles in the regions, np.compress), which releases
+    the interpreter lock. The gain over the legacy loop is mostly the
+    single allocation without the copy of the concatenation.
+"""
+
+class ConcurrentReader:
+
+    def __init__(self, dataloc, threads=None):
+        """
+            dataloc: location of any file of the snapshot
+            threads: number of threads of the pool, default: number of
+                     cpus (at most the number of files), see the note
+                     above on the HDF5 lock
+        """
+        self._meta = SnapshotMetadata.get(dataloc)
+        self._files = self._meta.files()
+        if threads is None:
+            threads = cpu_count()
+        self._threads = max(1, min(threads, len(self._files)))
+
+    def files(self):
+        return self._files
+
+    def num_part(self, itype):
+        """
+            Number of particles of type itype in each file
+        """
+        return self._meta.num_part(itype)
+
+    def map(self, function, items):
+        """
+            function applied to all items by the threads of a pool
+        """
+        if self._threads == 1:
+            return map(function, items)
+        pool = ThreadPool(self._threads)
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def read_dataset(self, itype, att, masks=None):
+        """
+            Attribute att of all particles of type itype, in file order
+            masks: list with a boolean array per file, only the particles
+                   with True are read (None: all particles)
+        """
+        numpart = self.num_part(itype)
+        counts = numpart if masks is None else np.array([m.sum() for m in masks], dtype='i8')
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        out = np.empty((offsets[-1],) + self._meta.row_shape(itype, att), dtype=self._meta.dtype(itype, att))
+
+        def read(i):
+            # Files without particles of this type have no PartType group
+            if counts[i] == 0:
+                return
+            with h5py.File(self._files[i], 'r') as f:
+                dset = f['PartType%i/%s'%(itype, att)]
+                if masks is None:
+                    dset.read_direct(out, np.s_[0:numpart[i]], np.s_[offsets[i]:offsets[i+1]])
+                else:
+                    np.compress(masks[i], dset[...], axis=0, out=out[offsets[i]:offsets[i+1]])
+
+        self.map(read, range(len(self._files)))
+        return out
+
+class ConcurrentSnapshot:
+    """
+        Stand-in for read_eagle.EagleSnapshot with plain h5py, see above
+    """
+    def __init__(self, dataloc, threads=None):
+        self._reader = ConcurrentReader(dataloc, threads)
+        self.boxsize = self._reader._meta.header('BoxSize')
+        self._regions = []
+        self._masks = {} # per particle type, set by masks
+
+    def select_region(self, xmin, xmax, ymin, ymax, zmin, zmax):
+        """
+            Add the particles in the region (in the units of the snapshot)
+            to the selection
+        """
+        self._regions.append((xmin, xmax, ymin, ymax, zmin, zmax))
+        self._masks = {}
+
+    def clear_selection(self):
+        self._regions = []
+        self._masks = {}
+
+    def masks(self, itype):
+        """
+            Which particles of each file are in the selected regions
+        """
+        if not itype in self._masks:
+            regions = np.array(self._regions, dtype='f8').reshape((-1, 6))
+            files = self._reader.files()
+            numpart = self._reader.num_part(itype)
+
+            def select(i):
+                mask = np.zeros(numpart[i], dtype=bool)
+                if numpart[i] == 0:
+                    return mask
+                with h5py.File(files[i], 'r') as f:
+                    pos = f['PartType%i/Coordinates'%itype][...]
+                for r in regions:
+                    mask |= (pos[:,0] >= r[0]) & (pos[:,0] <= r[1]) & \
+                            (pos[:,1] >= r[2]) & (pos[:,1] <= r[3]) & \
+                            (pos[:,2] >= r[4]) & (pos[:,2] <= r[5])
+                return mask
+
+            self._masks[itype] = self._reader.map(select, range(len(files)))
+        return self._masks[itype]
+
+    def read_dataset(self, itype, att):
+        """
+            Attribute att of the selected particles of type itype
+        """
+        return self._reader.read_dataset(itype, att, self.masks(itype))
@@ -0,0 +1,140 @@
+import operator
+import numpy as np
+
+"""
+    Attribute with the same value for every particle.
+
+    EAGLE does not store the masses of the dark matter particles, they all
+    have the mass given in the MassTable of the header. Instead of an array
+    with this value repeated for every particle, Filaments returns a
+    ConstantColumn for them, which is turned into an array only when a
+    consumer needs one (np.asarray, dumps, histograms, ...):
+
+        m = fil.data()['Mass']     # ConstantColumn, no memory per particle
+        m.sum(), m[mask].size      # still constant
+        m * 2, m / 1.989e33, m > 0 # still constant, with a scalar
+        m * density, np.log10(m)   # arrays of m.size values
+
+    Arithmetic and comparisons with a scalar (or another ConstantColumn of
+    the same length) give a ConstantColumn again, with anything else the
+    column is turned into an array first, like a column of gas masses.
+"""
+
+def _scalar(other):
+    return np.isscalar(other) or (isinstance(other, np.ndarray) and other.ndim == 0)
+
+def _binary(op):
+    """
+        Method applying op to the column and the other operand
+    """
+    def method(self, other):
+        if isinstance(other, ConstantColumn) and other.size == self.size:
+            other = other.value()
+        if _scalar(other):
+            # On one element, for the types of the result of an array
+            value = op(np.full(1, self._value, self.dtype), other)
+            return ConstantColumn(value[0], self.size, value.dtype)
+        return op(np.asarray(self), other)
+    return method
+
+def _reflected(op):
+    """
+        Method applying op to the other operand and the column
+    """
+    def method(self, other):
+        if _scalar(other):
+            value = op(other, np.full(1, self._value, self.dtype))
+            return ConstantColumn(value[0], self.size, value.dtype)
+        return op(other, np.asarray(self))
+    return method
+
+class ConstantColumn(object):
+
+    # Operations with numpy arrays are left to the methods below
+    __array_priority__ = 100
+
+    def __init__(self, value, length, dtype=None):
+        """
+            value: value of every particle
+            length: number of particles
+            dtype: data type of the arrays, default: type of value
+        """
+        self.dtype = np.dtype(dtype) if dtype is not None else np.asarray(value).dtype
+        self._value = self.dtype.type(value)
+        self.size = int(length)
+        self.shape = (self.size,)
+        self.ndim = 1
+
+    def value(self):
+        return self._value
+
+    def __len__(self):
+        return self.size
+
+    def __array__(self, dtype=None):
+        # The array is created here, on request of numpy
+        return np.full(self.size, self._value, dtype=dtype or self.dtype)
+
+    def __getitem__(self, index):
+        """
+            Column of the selected particles, a single value for an integer
+        """
+        if isinstance(index, (int, long, np.integer)):
+            if not -self.size <= index < self.size:
+                raise IndexError("index {} out of range for {} particles".format(index, self.size))
+            return self._value
+        if isinstance(index, slice):
+            return ConstantColumn(self._value, len(range(*index.indices(self.size))), self.dtype)
+
+        index = np.asarray(index)
+        if index.dtype == bool:
+            if index.shape != self.shape:
+                raise IndexError("mask of {} for {} particles".format(index.shape, self.size))
+            return ConstantColumn(self._value, np.count_nonzero(index), self.dtype)
+        if index.size > 0 and not (-self.size <= index.min() and index.max() < self.size):
+            raise IndexError("index out of range for {} particles".format(self.size))
+        return ConstantColumn(self._value, index.size, self.dtype)
+
+    def astype(self, dtype, copy=True):
+        """
+            Same column with values of type dtype, still constant
+        """
+        return ConstantColumn(self._value, self.size, dtype)
+
+    __add__, __radd__ = _binary(operator.add), _reflected(operator.add)
+    __sub__, __rsub__ = _binary(operator.sub), _reflected(operator.sub)
+    __mul__, __rmul__ = _binary(operator.mul), _reflected(operator.mul)
+    __div__, __rdiv__ = _binary(operator.div), _reflected(operator.div)
+    __truediv__, __rtruediv__ = _binary(operator.truediv), _reflected(operator.truediv)
+    __floordiv__, __rfloordiv__ = _binary(operator.floordiv), _reflected(operator.floordiv)
+    __pow__, __rpow__ = _binary(operator.pow), _reflected(operator.pow)
+
+    __lt__, __le__ = _binary(operator.lt), _binary(operator.le)
+    __gt__, __ge__ = _binary(operator.gt), _binary(operator.ge)
+    __eq__, __ne__ = _binary(operator.eq), _binary(operator.ne)
+    __hash__ = None
+
+    def __neg__(self):
+        return ConstantColumn(-self._value, self.size, self.dtype)
+
+    def __abs__(self):
+        return ConstantColumn(abs(self._value), self.size, self.dtype)
+
+    def min(self):
+        if self.size == 0:
+            raise ValueError("zero-size column has no minimum")
+        return self._value
+
+    def max(self):
+        if self.size == 0:
+            raise ValueError("zero-size column has no maximum")
+        return self._value
+
+    def sum(self):
+        return self._value * self.size
+
+    def mean(self):
+        return self._value if self.size > 0 else np.nan
+
+    def __repr__(self):
+        return "ConstantColumn({!r}, {})".format(self._value, self.size)
@@ -0,0 +1,220 @@
+import numpy as np
+import h5py
+
+from snapshot_metadata import SnapshotMetadata
+from concurrent_reader import ConcurrentReader, ConcurrentSnapshot
+from spatial_index import merge_ranges
+
+"""
+    read_eagle.EagleSnapshot with h5py and numpy, for nodes without
+    read_eagle. Only the interface used by Filaments is provided:
+    boxsize, select_region, clear_selection, count_particles, read_dataset.
+
+    Like read_eagle it uses the hash tables of EAGLE snapshots:
+    the box is divided into 2**HashBits cells per dimension, the cells are
+    numbered along a Peano--Hilbert curve (the key) and the particles of each
+    file are sorted by key, each file holding a range of keys:
+        HashTable                               attribute HashBits
+        HashTable/PartType<N>/FirstKeyInFile    first key of every file
+        HashTable/PartType<N>/LastKeyInFile     last key of every file
+        HashTable/PartType<N>/NumParticleInCell particles per key in this file
+    select_region selects all cells overlapping the region, read_dataset
+    reads the particles of these cells, consecutive cells with one read.
+    As with read_eagle these are all particles in the region and more.
+
+    Snapshots without hash tables are scanned completely instead, see
+    ConcurrentSnapshot in concurrent_reader.py.
+"""
+
+# Peano--Hilbert keys as in Gadget (peano.c): the octant of every level is
+# numbered according to the current rotation and sense of the curve.
+QUADRANTS = np.array([
+    # rotx = 0, roty = 0-3
+    [[[0, 7], [1, 6]], [[3, 4], [2, 5]]],
+    [[[7, 4], [6, 5]], [[0, 3], [1, 2]]],
+    [[[4, 3], [5, 2]], [[7, 0], [6, 1]]],
+    [[[3, 0], [2, 1]], [[4, 7], [5, 6]]],
+    # rotx = 1, roty = 0-3
+    [[[1, 0], [6, 7]], [[2, 3], [5, 4]]],
+    [[[0, 3], [7, 4]], [[1, 2], [6, 5]]],
+    [[[3, 2], [4, 5]], [[0, 1], [7, 6]]],
+    [[[2, 1], [5, 6]], [[3, 0], [4, 7]]],
+    # rotx = 2, roty = 0-3
+    [[[6, 1], [7, 0]], [[5, 2], [4, 3]]],
+    [[[1, 2], [0, 3]], [[6, 5], [7, 4]]],
+    [[[2, 5], [3, 4]], [[1, 6], [0, 7]]],
+    [[[5, 6], [4, 7]], [[2, 1], [3, 0]]],
+    # rotx = 3, roty = 0-3
+    [[[7, 6], [0, 1]], [[4, 5], [3, 2]]],
+    [[[6, 5], [1, 2]], [[7, 4], [0, 3]]],
+    [[[5, 4], [2, 3]], [[6, 7], [1, 0]]],
+    [[[4, 7], [3, 0]], [[5, 6], [2, 1]]],
+    # rotx = 4, roty = 0-3
+    [[[6, 7], [5, 4]], [[1, 0], [2, 3]]],
+    [[[7, 0], [4, 3]], [[6, 1], [5, 2]]],
+    [[[0, 1], [3, 2]], [[7, 6], [4, 5]]],
+    [[[1, 6], [2, 5]], [[0, 7], [3, 4]]],
+    # rotx = 5, roty = 0-3
+    [[[2, 3], [1, 0]], [[5, 4], [6, 7]]],
+    [[[3, 4], [0, 7]], [[2, 5], [1, 6]]],
+    [[[4, 5], [7, 6]], [[3, 2], [0, 1]]],
+    [[[5, 2], [6, 1]], [[4, 3], [7, 0]]]])
+ROTXMAP = np.array([4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 0, 1, 2, 3, 17, 18, 19, 16, 23, 20, 21, 22])
+ROTYMAP = np.array([1, 2, 3, 0, 16, 17, 18, 19, 11, 8, 9, 10, 22, 23, 20, 21, 14, 15, 12, 13, 4, 5, 6, 7])
+ROTX = np.array([3, 0, 0, 2, 2, 0, 0, 1])
+ROTY = np.array([0, 1, 1, 2, 2, 3, 3, 0])
+SENSE = np.array([-1, -1, -1, 1, 1, -1, -1, -1])
+
+def peano_hilbert_keys(x, y, z, bits):
+    """
+        Keys of the cells with integer coordinates x, y, z (arrays,
+        0 <= x < 2**bits) on the Peano--Hilbert curve
+    """
+    x, y, z = [np.asarray(v, dtype='i8') for v in (x, y, z)]
+    key = np.zeros(x.shape, dtype='i8')
+    rotation = np.zeros(x.shape, dtype='i8')
+    sense = np.ones(x.shape, dtype='i8')
+
+    for level in range(bits - 1, -1, -1):
+        quad = QUADRANTS[rotation, (x >> level) & 1, (y >> level) & 1, (z >> level) & 1]
+        key = (key << 3) + np.where(sense == 1, quad, 7 - quad)
+
+        rotx, roty = ROTX[quad], ROTY[quad]
+        sense = sense * SENSE[quad]
+        for i in range(3):
+            rotation = np.where(rotx > i, ROTXMAP[rotation], rotation)
+        for i in range(3):
+            rotation = np.where(roty > i, ROTYMAP[rotation], rotation)
+    return key
+
+class EagleSnapshot:
+
+    def __init__(self, fname, threads=None):
+        """
+            fname: location of any file of the snapshot
+            threads: number of threads of the pool the files are read
+                     with, see concurrent_reader.py
+        """
+        self._reader = ConcurrentReader(fname, threads)
+        self._meta = SnapshotMetadata.get(fname)
+        self.boxsize = self._meta.header('BoxSize')
+
+        # From the cached metadata, see snapshot_metadata.py
+        self._hashbits = self._meta.hash_bits()
+        self._scan = None
+        if self._hashbits is None:
+            print "No hash tables in the snapshot, scanning all particles."
+            self._scan = ConcurrentSnapshot(fname, threads)
+
+        self._regions = [] # keys of the cells of every region
+        self._keys = None # all selected keys, set by keys
+        self._cells = {} # per particle type: first and last keys, particles per cell
+
+    def select_region(self, xmin, xmax, ymin, ymax, zmin, zmax):
+        """
+            Add all cells overlapping the region (in the units of the
+            snapshot, periodic) to the selection
+        """
+        if self._scan is not None:
+            self._scan.select_region(xmin, xmax, ymin, ymax, zmin, zmax)
+            return
+
+        ncells = 2**self._hashbits
+        cell = self.boxsize/ncells
+        axes = [np.arange(int(np.floor(lo/cell)), int(np.floor(hi/cell)) + 1)
+                for lo, hi in [(xmin, xmax), (ymin, ymax), (zmin, zmax)]]
+        # Regions larger than the box contain every cell once
+        axes = [np.unique(axis % ncells) for axis in axes]
+        x, y, z = np.meshgrid(*axes, indexing='ij')
+        self._regions.append(peano_hilbert_keys(x.ravel(), y.ravel(), z.ravel(), self._hashbits))
+        self._keys = None
+
+    def clear_selection(self):
+        if self._scan is not None:
+            self._scan.clear_selection()
+        self._regions = []
+        self._keys = None
+
+    def keys(self):
+        """
+            Sorted keys of all selected cells
+        """
+        if self._keys is None:
+            if len(self._regions) == 0:
+                self._keys = np.empty(0, dtype='i8')
+            else:
+                self._keys = np.unique(np.concatenate(self._regions))
+        return self._keys
+
+    def cells(self, itype):
+        """
+            First and last key of every file and the number of particles
+            of type itype in every cell of every file, read once
+        """
+        if not itype in self._cells:
+            files = self._reader.files()
+            numpart = self._reader.num_part(itype)
+            with h5py.File(files[0], 'r') as f:
+                first = f['HashTable/PartType%i/FirstKeyInFile'%itype][...].astype('i8')
+                last = f['HashTable/PartType%i/LastKeyInFile'%itype][...].astype('i8')
+
+            def read(i):
+                if numpart[i] == 0:
+                    return np.zeros(last[i] - first[i] + 1, dtype='i8')
+                with h5py.File(files[i], 'r') as f:
+                    return f['HashTable/PartType%i/NumParticleInCell'%itype][...].astype('i8')
+
+            self._cells[itype] = (first, last, self._reader.map(read, range(len(files))))
+        return self._cells[itype]
+
+    def ranges(self, itype):
+        """
+            Row ranges (starts, stops) of the selected cells in every file,
+            consecutive cells merged into one range
+        """
+        keys = self.keys()
+        first, last, counts = self.cells(itype)
+
+        ranges = []
+        for i in range(len(counts)):
+            lo, hi = np.searchsorted(keys, [first[i], last[i] + 1])
+            local = keys[lo:hi] - first[i]
+            offsets = np.concatenate([[0], np.cumsum(counts[i])])
+            ranges.append(merge_ranges(offsets[local], offsets[local + 1]))
+        return ranges
+
+    def count_particles(self, itype):
+        """
+            Number of selected particles of type itype
+        """
+        if self._scan is not None:
+            return int(sum(mask.sum() for mask in self._scan.masks(itype)))
+        return int(sum((stops - starts).sum() for starts, stops in self.ranges(itype)))
+
+    def read_dataset(self, itype, att):
+        """
+            Attribute att of the particles of type itype in the selected
+            cells, in the order of the files and keys
+        """
+        if self._scan is not None:
+            return self._scan.read_dataset(itype, att)
+
+        files = self._reader.files()
+        ranges = self.ranges(itype)
+        counts = [int((stops - starts).sum()) for starts, stops in ranges]
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype('i8')
+
+        out = np.empty((offsets[-1],) + self._meta.row_shape(itype, att), dtype=self._meta.dtype(itype, att))
+
+        def read(i):
+            if counts[i] == 0:
+                return
+            with h5py.File(files[i], 'r') as f:
+                dset = f['PartType%i/%s'%(itype, att)]
+                pos = offsets[i]
+                for start, stop in zip(*ranges[i]):
+                    dset.read_direct(out, np.s_[start:stop], np.s_[pos:pos + stop - start])
+                    pos += stop - start
+
+        self._reader.map(read, range(len(files)))
+        return out
@@ -1,37 +1,270 @@
 import numpy as np
-from shutil import copyfile
-from subprocess import Popen
+import h5py
+from shutil import copyfileobj
+
+"""
+    Output of the particles of a filament.
+
+    The format follows from the file extension of outfile:
+     .hdf5 / .h5 -> one chunked, gzip compressed dataset per attribute,
+                    metadata (e.g. conversion factors) as attributes of
+                    the datasets, rows can be appended by later shards
+     otherwise   -> csv, attributes as columns, attributes with several
+                    components (Coordinates) are split into one column each:
+                    Coordinates_0, Coordinates_1, Coordinates_2
+"""
+
+def is_hdf5(fname):
+    return fname.endswith('.hdf5') or fname.endswith('.h5')
 
 class FilamentDump:
     def __init__(self):
         pass
 
-    def dump(self, fdict, outfile):
+    def dump(self, fdict, outfile, attrs=None, header=None, append=False):
         """
-            Dump filament dictionary to csv
+            Dump filament dictionary to outfile
             -> keys as rownames and data as columns
+            attrs: dictionary attribute -> dictionary of metadata of this
+                   attribute (hdf5 only)
+            header: dictionary of metadata of the whole dump (hdf5 only)
+            append: append rows to an existing dump (hdf5 only)
+        """
+        if is_hdf5(outfile):
+            self.dump_hdf5(fdict, outfile, attrs, header, append)
+        else:
+            if append:
+                print "Appending is only possible for hdf5 dumps."
+                return
+            self.dump_csv(fdict, outfile)
+
+    def dump_csv(self, fdict, outfile):
         """
-        header = str(fdict.keys()).strip("[]").replace("'","")
+            Dump filament dictionary to csv
+        """
+        names, columns = [], []
+        for key, vals in fdict.items():
+            vals = np.asarray(vals)
+            if len(vals.shape) == 1:
+                names.append(key)
+                columns.append(vals)
+            else:
+                for i in range(vals.shape[1]):
+                    names.append("{}_{}".format(key, i))
+                    columns.append(vals[:,i])
+
+        header = ", ".join(names)
 
-        n_att = len(fdict) # Number of attributes / columns
-        n_points = fdict.values()[0].size # Number of points
+        n_att = len(columns) # Number of columns
+        n_points = columns[0].size # Number of points
 
         data = np.empty((n_points, n_att))
 
-        for i, vals in enumerate(fdict.values()):
+        for i, vals in enumerate(columns):
             data[:,i] = vals
 
         np.savetxt(outfile, data, header=header, delimiter=",")
 
-    def gather(self, files, outfile):
-        # copy first, then append data from others
-        if len(files) > 0:
-            copyfile(files[0], outfile)
+    def dump_hdf5(self, fdict, outfile, attrs=None, header=None, append=False):
+        """
+            Dump filament dictionary to hdf5, one dataset per attribute
+        """
+        f = h5py.File(outfile, 'a' if append else 'w')
+
+        # When appending all attributes must be there already
+        if append and len(f.keys()) > 0 and sorted(f.keys()) != sorted(fdict.keys()):
+            print "Attributes don't match the ones in", outfile
+            print "In file:", list(f.keys())
+            f.close()
+            return
+
+        for key, vals in fdict.items():
+            vals = np.asarray(vals)
+            if key in f:
+                dset = f[key]
+                n = dset.shape[0]
+                dset.resize(n + vals.shape[0], axis=0)
+                dset[n:] = vals
+            else:
+                dset = f.create_dataset(key, data=vals, maxshape=(None,) + vals.shape[1:],
+                                        chunks=True, compression='gzip', shuffle=True)
+            if attrs is not None and key in attrs:
+                for name, value in attrs[key].items():
+                    dset.attrs[name] = value
+
+        if header is not None:
+            for name, value in header.items():
+                f.attrs[name] = value
+
+        f.close()
+
+    def load(self, infile):
+        """
+            Read a dump back into a dictionary
+        """
+        data = {}
+        if is_hdf5(infile):
+            with h5py.File(infile, 'r') as f:
+                for key in f.keys():
+                    data[str(key)] = f[key][...]
+        else:
+            with open(infile, 'r') as f:
+                names = [name.strip() for name in f.readline().strip('# \n').split(',')]
+            values = np.loadtxt(infile, delimiter=",", ndmin=2)
+            for i, name in enumerate(names):
+                data[name] = values[:,i]
+
+        return data
+
+    def gather(self, files, outfile, unique=None, virtual=False, block=2**20):
+        """
+            Merge the dumps files (e.g. of the shards of run.sh) into outfile,
+            all of them must have the same attributes.
+            unique: name of an attribute identifying the particles, e.g.
+                    'ParticleIDs', particles already contained in a previous
+                    file are skipped, otherwise all rows are kept
+            virtual: hdf5 only, create virtual datasets referring to the
+                     files instead of copying them (not with unique)
+            block: number of rows copied at once (hdf5)
+        """
+        if len(files) == 0:
+            print "No files to gather."
+            return
+
+        if is_hdf5(outfile):
+            if virtual and unique is None:
+                self.gather_virtual(files, outfile)
+            else:
+                self.gather_hdf5(files, outfile, unique, block)
+        else:
+            self.gather_csv(files, outfile, unique)
+
+    def _unique_mask(self, ids, seen):
+        """
+            Which of ids are not in seen? Returns the mask and the updated seen.
+        """
+        keep = np.logical_not(np.in1d(ids, seen))
+        return keep, np.union1d(seen, ids[keep])
+
+    def gather_csv(self, files, outfile, unique=None):
+        """
+            Concatenate csv dumps, the header is written once.
+        """
+        headers = []
+        for fname in files:
+            with open(fname, 'r') as f:
+                headers.append(f.readline())
+        if any(header != headers[0] for header in headers):
+            print "Column headers of the files don't match, not gathering."
+            return
+
+        if unique is not None:
+            names = [name.strip() for name in headers[0].strip('# \n').split(',')]
+            if not unique in names:
+                print "Column", unique, "not in the files, not gathering."
+                return
+            column = names.index(unique)
+            seen = np.empty(0)
+
+        with open(outfile, 'w') as out:
+            out.write(headers[0])
+            for fname in files:
+                with open(fname, 'r') as f:
+                    f.readline() # header
+                    if unique is None:
+                        copyfileobj(f, out)
+                        continue
+
+                    ids = np.loadtxt(fname, delimiter=",", usecols=(column,), ndmin=1)
+                    keep, seen = self._unique_mask(ids, seen)
+                    for line, k in zip(f, keep):
+                        if k:
+                            out.write(line)
+
+    def _check_hdf5(self, files):
+        """
+            Do all hdf5 files have the same datasets with the same shape per row?
+            Returns a dictionary key -> (number of rows per file, shape, dtype)
+            or None if not.
+        """
+        layout = None
+        for fname in files:
+            with h5py.File(fname, 'r') as f:
+                this = dict((str(key), (f[key].shape[1:], f[key].dtype)) for key in f.keys())
+                rows = dict((str(key), f[key].shape[0]) for key in f.keys())
+            if layout is None:
+                layout = dict((key, ([], shape, dtype)) for key, (shape, dtype) in this.items())
+            if sorted(this.keys()) != sorted(layout.keys()) or \
+                    any(this[key][0] != layout[key][1] for key in this):
+                print "Datasets of", fname, "don't match the ones of", files[0]
+                return None
+            for key in layout:
+                layout[key][0].append(rows[key])
+        return layout
+
+    def gather_hdf5(self, files, outfile, unique=None, block=2**20):
+        """
+            Copy hdf5 dumps into one, block rows at a time.
+        """
+        layout = self._check_hdf5(files)
+        if layout is None:
+            return
+        if unique is not None and not unique in layout:
+            print "Dataset", unique, "not in the files, not gathering."
+            return
+
+        seen = np.empty(0)
+        out = h5py.File(outfile, 'w')
+        for i, fname in enumerate(files):
+            f = h5py.File(fname, 'r')
+            if i == 0:
+                # Same datasets and metadata as the first file, but empty
+                for name, value in f.attrs.items():
+                    out.attrs[name] = value
+                for key in layout:
+                    dset = out.create_dataset(key, shape=(0,) + layout[key][1], dtype=layout[key][2],
+                                              maxshape=(None,) + layout[key][1],
+                                              chunks=True, compression='gzip', shuffle=True)
+                    for name, value in f[key].attrs.items():
+                        dset.attrs[name] = value
+
+            n = f[layout.keys()[0]].shape[0]
+            for start in range(0, n, block):
+                stop = min(start + block, n)
+                keep = slice(None)
+                if unique is not None:
+                    keep, seen = self._unique_mask(f[unique][start:stop], seen)
+                for key in layout:
+                    vals = f[key][start:stop][keep]
+                    dset = out[key]
+                    m = dset.shape[0]
+                    dset.resize(m + vals.shape[0], axis=0)
+                    dset[m:] = vals
+            f.close()
+        out.close()
 
-        if not len(files) > 1:
+    def gather_virtual(self, files, outfile):
+        """
+            Virtual datasets concatenating the datasets of the hdf5 dumps,
+            no data is copied, the files must stay where they are.
+        """
+        layout = self._check_hdf5(files)
+        if layout is None:
             return
 
-        for f in files[1:]:
-            # Skip first row (= rownames and append rest)
-            bash = "tail -n +2 {} >> {}".format(f, outfile)
-            Popen(bash, shell=True)
+        out = h5py.File(outfile, 'w')
+        with h5py.File(files[0], 'r') as f:
+            for name, value in f.attrs.items():
+                out.attrs[name] = value
+            attrs = dict((key, dict(f[key].attrs.items())) for key in layout)
+
+        for key, (rows, shape, dtype) in layout.items():
+            vlayout = h5py.VirtualLayout(shape=(sum(rows),) + shape, dtype=dtype)
+            offset = 0
+            for fname, n in zip(files, rows):
+                vlayout[offset:offset+n] = h5py.VirtualSource(fname, key, shape=(n,) + shape)
+                offset += n
+            dset = out.create_virtual_dataset(key, vlayout)
+            for name, value in attrs[key].items():
+                dset.attrs[name] = value
+        out.close()
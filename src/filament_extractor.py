@@ -1,21 +1,44 @@
 # General imports
+import os
+import copy
+import hashlib
 import numpy as np
 import h5py
 import matplotlib.pyplot as plt
 
 # EAGLE imports
-from read_eagle import EagleSnapshot
+try:
+    from read_eagle import EagleSnapshot
+except ImportError:
+    # Read the files with plain h5py instead, see eagle_snapshot.py
+    from eagle_snapshot import EagleSnapshot
 #from read_header import read_header
 
 # Filament catalogue imports
 from catalogue_reader import CatalogueReader
 from filament_dump import FilamentDump
+from spatial_index import CentreGrid, SegmentGrid, covering_regions
+from spatial_index import QUERY_BYTES_PER_PARTICLE, QUERY_BYTES_PER_PAIR
+from snapshot_reader import SnapshotReader
+from particle_data import ParticleData
+from selection_cache import SelectionCache
+from parallel_selection import parallel_select
+from membership import Membership
+from histogram import Histogram
+from phase_diagram import PhaseDiagram
+from snapshot_metadata import SnapshotMetadata
+from constant_column import ConstantColumn
+from instrumentation import make_profiler
+from particle_index import ParticleIndex
 
 class Filaments:
     """
         Class to handle read-in and visualisation of particle properties near filaments
     """
-    def __init__(self, attributes, catalogue, box_length=1, catalogue_index=None, part_type=0):
+    def __init__(self, attributes, catalogue, box_length=1, catalogue_index=None, part_type=0,
+                 engine='grid', max_memory=None, cache=None, processes=None, centre_chunks=None,
+                 selection='cube', max_segment=None, precision='f8', profile=None,
+                 particle_index=False):
         """
             attributes: which attributes to load?
                         -> e.g. ['Density', 'Temperature']
@@ -24,19 +47,99 @@ class Filaments:
             catalogue_index: all particles in filament catalogue (None)
                              or in the range [index[0], index[-1]]?
             box_length: cube length of particle region
+            part_type: particle type (0 gas, 1 dark matter, 4 stars, ...)
+                       or list of them, which are selected in one pass
+                       with the same centres, volumes and cell grid, see
+                       part and data; each type only loads the attributes
+                       it has
+            engine: how to find the particles in the readout volumes
+                    'grid' -> cell grid over the volumes (see spatial_index.py)
+                    'loop' -> test every particle against every volume,
+                              slow, but useful to cross-check 'grid'
+            max_memory: None -> read the whole region at once with read_eagle
+                                (or eagle_snapshot.py if not installed)
+                        number of bytes -> stream the snapshot in hyperslabs
+                        with a working memory of about max_memory bytes
+            cache: SelectionCache to store the selected particles in and
+                   reuse them if the same selection is made again
+                   --> see file selection_cache.py
+            processes: number of processes to select the particles with,
+                       the centres are split among them (only without
+                       max_memory, see parallel_selection.py)
+            centre_chunks: iterator over blocks of centres (offset, centres),
+                           e.g. catalogue.iter_chunks(100000), used instead
+                           of catalogue_index, the selection is the union of
+                           the selections of all blocks
+            selection: shape of the filament region
+                       'cube' -> cubes with half edge length box_length
+                                 around the centres
+                       'tube' -> all particles closer than box_length to the
+                                 segments between consecutive centres
+                                 (only with engine 'grid')
+            max_segment: consecutive centres farther apart than max_segment
+                         are not connected by a segment ('tube' only),
+                         default: 3 times the median distance of
+                         consecutive centres, at most half the cube length
+            precision: data type of the converted attributes
+                       'f8'     -> float64, as the original conversion
+                       'native' -> type of the snapshot (float32 for most
+                                   EAGLE datasets), converted in place
+                       'log10'  -> log10 of the values as float32,
+                                   converted in place, see logged
+                       Coordinates always keep the type of the snapshot.
+            profile: json lines file for the time and memory of the stages,
+                     '-' for stdout, None: environment variable
+                     FILAMENTS_PROFILE, default off, see instrumentation.py
+            particle_index: True -> read only the particles in the cells of
+                            the index built with build_index.py touched by
+                            the readout boxes (see particle_index.py),
+                            used instead of read_eagle and max_memory;
+                            without an up to date index read as if False
+                            directory -> the same with the index built in
+                            this directory instead of the cache directory
         """
 
         # Save parameters & variables
         self._att = attributes
         self._itype = part_type
+        self._engine = engine
+        self._max_memory = max_memory
+        self._cache = cache
+        self._processes = processes
+        self._box_length = box_length
+        self._selection = selection
+        self._max_segment = max_segment
+        self._precision = precision
+        self._particle_index = particle_index
         self._data = None # will be set by read_particles
+        self._centres = None # will be set by read_filament_centres
+        self._volumes = None # will be set by get_readout_volumes
+        self._index = None # will be set by read_particles
+        self._distance = None # will be set by distances
+        self._membership = None # will be set by membership
+        self._units = {} # will be set by convert
+        self._grids = {} # will be set by make_grid, shared by all types
+        self._snapshot = None # will be set by open_region, shared by all types
+        self._parts = None # will be set for several particle types
+        self._pindex = None # will be set by open_snapshot with particle_index
 
         # Set instance of FilamentDump, might need it later
         self._dumper = FilamentDump()
 
-        # Load information from the header
+        # Time and memory of the stages, shared by all particle types
+        shard = None
+        if catalogue_index is not None:
+            shard = [int(np.min(catalogue_index)), int(np.max(catalogue_index))]
+        self._profile = make_profiler(profile, catalogue=catalogue.fname(), catalogue_index=shard,
+                                      box_length=box_length, part_type=part_type, selection=selection,
+                                      max_memory=max_memory, processes=processes)
+
+        # Load information from the header, shared by all Filaments
+        # objects of the same snapshot, see snapshot_metadata.py
         self._a, self._h, self._boxsize = catalogue.header_info()
         self._dataloc = catalogue.snap_loc()
+        self._meta = SnapshotMetadata.get(self._dataloc)
+        self._catalogue_loc = catalogue.fname()
         self._cube_length = catalogue.cube_length()
 
         # Get filament centres from filament catalogue as defined by indices
@@ -44,21 +147,94 @@ class Filaments:
         # catalogue index is set, otherwise it just reads all centres
         # This doesn't return anything, it directly sets the variable
         # self._centres to a 2d array of the centres, shape (ncentres, 3)
-        self.read_filament_centres(catalogue, catalogue_index)
+        with self._profile.stage('centres') as stage:
+            if centre_chunks is None:
+                self.read_filament_centres(catalogue, catalogue_index)
+            else:
+                self.read_centre_chunks(centre_chunks)
+            stage.add(centres=0 if self._centres is None else self._centres.shape[0])
         # Get the box volumes around the centres as defined by load_region_length
         # Directly sets self._volumes to a 2d array, shape (ncentres, 6)
-        self.get_readout_volumes(box_length)
+        # For tubes also the segments between the centres
+        # Directly sets self._segments to two 2d arrays, shape (nsegments, 3)
+        with self._profile.stage('volumes'):
+            self.get_readout_volumes(box_length)
+            if self._selection == 'tube':
+                self.get_segments(max_segment)
         # Load data thats within self._volumes
-        self.read_particles()
+        if isinstance(part_type, (list, tuple)):
+            self.read_part_types(part_type)
+        else:
+            self.read_particles()
+        self._profile.flush()
+
+    def read_part_types(self, part_types):
+        """
+            Select the particles of each type in part_types, everything
+            that doesn't depend on the type is shared: the centres, volumes,
+            the cell grid and the region selected with read_eagle.
+            Sets self._parts to a Filaments object per type and self._data
+            to a dictionary type -> data of that type.
+        """
+        if self._max_memory is None and not self._particle_index and not self.empty():
+            with self._profile.stage('open_snapshot'):
+                self.open_region()
+
+        self._parts = {}
+        for itype in part_types:
+            part = copy.copy(self)
+            part._itype = itype
+            part._parts = None
+            # Only the attributes this type has, e.g. no Density for dark matter
+            part._att = [att for att in self._att if part.available(att)]
+            missing = [att for att in self._att if not att in part._att]
+            if len(missing) > 0:
+                print "Particle type {} has no {}, not loaded for it.".format(itype, missing)
+            part._units = {}
+            part.read_particles()
+            self._parts[itype] = part
+
+        self._data = dict((itype, part.data()) for itype, part in self._parts.items())
+
+    def single_type(self, method):
+        """
+            Is only one particle type loaded? The methods for the particles
+            of one type (dump, hist, scale, ...) have to be called on
+            part(itype) otherwise.
+        """
+        if self._parts is None:
+            return True
+        print "{} works on one particle type, use part(itype) with itype in {}.".format(method, self.part_types())
+        return False
+
+    def part_types(self):
+        if self._parts is None:
+            return [self._itype]
+        return sorted(self._parts.keys())
+
+    def part(self, itype):
+        """
+            Filaments object of the particles of type itype, with all the
+            methods of a single type (hist, dump, scales, ...)
+        """
+        if self._parts is None:
+            if itype != self._itype:
+                print "Particle type {} wasn't loaded, only {}.".format(itype, self._itype)
+                return
+            return self
+        if not itype in self._parts:
+            print "Particle type {} wasn't loaded, only {}.".format(itype, self.part_types())
+            return
+        return self._parts[itype]
 
     def read_filament_centres(self, catalogue, catalogue_index):
         """
             Read filament centres from filament catalogue as specified
             in catalogue index
         """
-        # Info
+        # Info, number of rows before the filter of the catalogue (if any)
         self._num_centres = catalogue.num_centres()
-        print "Number of centres in filament:", self._num_centres
+        print "Number of centres in catalogue:", self._num_centres
 
         if catalogue_index is None:
             self._centres = catalogue.load()
@@ -106,6 +282,20 @@ class Filaments:
             if len(self._centres.shape) == 1:
                 self._centres = self._centres.reshape((1,3))
 
+    def read_centre_chunks(self, centre_chunks):
+        """
+            Collect the centres of all blocks of centre_chunks, only the
+            coordinates of the centres are kept, not the full blocks.
+        """
+        blocks = [np.empty((0, 3))]
+        for offset, centres in centre_chunks:
+            print "Read", centres.shape[0], "centres of the block at row", offset
+            blocks.append(np.array(centres).reshape((-1, 3)))
+
+        self._centres = np.concatenate(blocks)
+        self._num_centres = self._centres.shape[0]
+        print "Number of centres in filament:", self._num_centres
+
     def get_readout_volumes(self, box_length):
         """
             For each centre c define the readout volume as an array of size 6:
@@ -114,61 +304,300 @@ class Filaments:
         """
 
         # Valid function call?
-        if self._num_centres < 1 or self._centres is None:
+        if self._centres is None:
             print "No centres loaded! Cannot define readout volumes."
             return
+        # e.g. all centres rejected by the filter of the catalogue
+        if self._centres.shape[0] == 0:
+            print "No centres left, selecting no particles."
+            self._volumes = np.empty((0, 6))
+            return
         if not (box_length > 0 and box_length <= self._cube_length):
             print "Invalid box length, must be: 0 < box_length <= cube_length ({}).".format(self._cube_length)
             return
 
-        self._volumes = np.empty((self._num_centres, 6))
+        # One volume per loaded centre (not per centre in the catalogue)
+        self._volumes = np.empty((self._centres.shape[0], 6))
         for i, centre in enumerate(self._centres):
             # Lazy writing for: array([[xmin, xmax], [ymin, ymax], [zmin, zmax]])
             box = np.array([[c - box_length, c + box_length] for c in centre])
             # Flatten to make it array([xmin, xmax, ymin, ymax, zmin, zmax])
             self._volumes[i,:] = box.flatten()
 
-    def read_particles(self):
+    def get_segments(self, max_segment):
         """
-            Load particles from simulation
+            Segments between consecutive centres, the ones longer than
+            max_segment are not part of the filament. By default these are
+            the jumps between separate filaments of the catalogue (and
+            across the periodic box), much longer than the usual spacing of
+            the centres. Sets self._max_segment to the length used.
+            Centres without any segment become segments of zero length,
+            i.e. spheres around the centre.
         """
+        if self._volumes is None:
+            return
+        if self._volumes.shape[0] == 0:
+            self._segments = (np.empty((0, 3)), np.empty((0, 3)))
+            return
 
-        data = {}
+        starts, ends = self._centres[:-1], self._centres[1:]
+        length = np.sqrt(((ends - starts)**2).sum(axis=1))
+        if max_segment is None and length.size > 0:
+            max_segment = min(3*np.median(length), 0.5*self._cube_length)
+            print "Connecting centres closer than {:.3g} cMpc.".format(max_segment)
+        self._max_segment = max_segment
+        keep = length <= max_segment if max_segment is not None else np.ones(length.size, dtype=bool)
 
-        # Initialize read_eagle module.
-        eagle_data = EagleSnapshot(self._dataloc)
+        used = np.zeros(self._centres.shape[0], dtype=bool)
+        used[:-1] |= keep
+        used[1:] |= keep
+        lonely = self._centres[np.logical_not(used)]
 
-        # Select entire cube region
-        eagle_cube_length = eagle_data.boxsize
-        print "EAGLE box size:", eagle_cube_length
-        print ""
-        region = np.array([3*[0, eagle_cube_length]]).flatten()
-        eagle_data.select_region(*region)
+        self._segments = (np.concatenate([starts[keep], lonely]), np.concatenate([ends[keep], lonely]))
+        print "Number of segments:", self._segments[0].shape[0]
+
+    def readout_boxes(self):
+        """
+            Boxes containing the filament region: the volumes for cubes,
+            the cells of the SegmentGrid the tubes pass through for tubes.
+        """
+        if self._selection == 'tube':
+            return self.make_grid().boxes()
+        return self._volumes
+
+    def empty(self):
+        """
+            No particles to select: no centres left, e.g. after the
+            filter of the catalogue
+        """
+        return self._volumes is not None and self._volumes.shape[0] == 0
 
-        # Read all data
-        f = h5py.File(self._dataloc, 'r')
+    def make_grid(self, max_pairs=2**22):
+        """
+            Cell grid to select the particles with: CentreGrid over the
+            volumes for cubes or SegmentGrid over the segments for tubes.
+            Built once and reused, also by the other particle types.
+        """
+        if not max_pairs in self._grids:
+            if self._selection == 'tube':
+                grid = SegmentGrid(self._segments[0], self._segments[1], self._box_length, max_pairs)
+            else:
+                grid = CentreGrid(self._volumes, max_pairs)
+            self._grids[max_pairs] = grid
+        return self._grids[max_pairs]
+
+    def read_particles(self):
+        """
+            Load particles from simulation
+            Only the coordinates are read here to find the particles in the
+            filament, all other attributes are read for these particles on
+            first access of data()[att], see fetch.
+        """
+
+        if not self._engine in ['grid', 'loop']:
+            print "Invalid selection engine '{}', must be 'grid' or 'loop'.".format(self._engine)
+            return
+        if not self._selection in ['cube', 'tube']:
+            print "Invalid selection '{}', must be 'cube' or 'tube'.".format(self._selection)
+            return
+        if not self._precision in ['f8', 'native', 'log10']:
+            print "Invalid precision '{}', must be 'f8', 'native' or 'log10'.".format(self._precision)
+            return
+        if self._selection == 'tube' and self._engine != 'grid':
+            print "Tubes can only be selected with engine 'grid'."
+            return
 
         # Read coordinates as well, need them to extract the particles in the
         # volumes of the filaments
         if not 'Coordinates' in self._att:
             self._att += ['Coordinates']
 
-        # * Step 1 *
-        # Read data from all particles in the simulation at given snapshot
-        for att in self._att:
-            tmp  = eagle_data.read_dataset(self._itype, att)
-            cgs  = f['PartType%i/%s'%(self._itype, att)].attrs.get('CGSConversionFactor')
-            aexp = f['PartType%i/%s'%(self._itype, att)].attrs.get('aexp-scale-exponent')
-            hexp = f['PartType%i/%s'%(self._itype, att)].attrs.get('h-scale-exponent')
-            if att == 'Coordinates':
-                data[att] = tmp/self._h # Get co-moving coordinates
+        # Nothing to read without centres, all attributes are empty
+        if self.empty():
+            self._index = np.empty(0, dtype='i8')
+            self._data = ParticleData(self.fetch)
+            print "Selected 0 particles."
+            return
+
+        # Prepare reading: the region to read with read_eagle or the hyperslabs
+        with self._profile.stage('open_snapshot', self._itype):
+            self.open_snapshot()
+
+        # Did we select these particles before?
+        coords = None
+        if self._cache is not None:
+            key = self.selection_key()
+            self._index = self._cache.get(key)
+
+        # Sets self._index to the indices of the selected particles
+        if self._index is None:
+            if self.mode() == 'index':
+                coords = self.read_indexed()
+            elif self.mode() == 'region':
+                coords = self.read_region()
             else:
-                data[att] = np.multiply(tmp, cgs * self._a**aexp * self._h**hexp, dtype='f8')
-        f.close()
+                coords = self.read_streaming()
+            if self._cache is not None:
+                self._cache.put(key, self._index)
+        else:
+            print "Using cached selection."
+        print "Selected {} particles.".format(self._index.size)
+
+        self._data = ParticleData(self.fetch)
+        if coords is not None:
+            self._data['Coordinates'] = coords
+
+    def selection_key(self):
+        """
+            Key of the selection in the cache: everything the selected
+            particles depend on.
+        """
+        mode = self.mode()
+        centres = hashlib.sha1(np.ascontiguousarray(self._centres)).hexdigest()
+        return self._cache.key(self._dataloc, os.path.getmtime(self._dataloc),
+                               self._catalogue_loc, os.path.getmtime(self._catalogue_loc),
+                               centres, self._box_length, self._itype, mode,
+                               self._selection, self._max_segment)
+
+    def fetch(self, att):
+        """
+            Read attribute att of the selected particles and convert it
+            The masses of dark matter are the same for all particles and
+            not stored, they are returned as ConstantColumn.
+        """
+        if not self.available(att):
+            raise KeyError("Particle type {} has no attribute {}.".format(self._itype, att))
+        mass = self.mass_table(att)
+        if mass is not None:
+            value = self.convert(att, np.array([mass]))
+            return ConstantColumn(value[0], self._index.size, value.dtype)
+
+        with self._profile.stage('read', self._itype) as stage:
+            if self._index.size == 0:
+                tmp = np.empty((0,) + self._meta.row_shape(self._itype, att), dtype=self._meta.dtype(self._itype, att))
+            elif self.mode() == 'index':
+                tmp = self._reader.read_index(self._itype, att, self._index)
+                stage.add(bytes_read=tmp.nbytes)
+            elif self.mode() == 'region':
+                # read_eagle can only read the whole selected region
+                tmp = self._snapshot.read_dataset(self._itype, att)
+                stage.add(bytes_read=tmp.nbytes)
+                tmp = tmp[self._index]
+            else:
+                tmp = self._reader.read_rows(self._itype, att, self._index, self._max_rows)
+                # Only the hyperslabs with selected particles are read
+                stage.add(bytes_read=tmp.nbytes)
+
+        with self._profile.stage('convert', self._itype):
+            return self.convert(att, tmp)
+
+    def add_attributes(self, attributes):
+        """
+            Add attributes to the selection, they are read on first access
+            without selecting the particles again.
+            For several particle types to each type that has them.
+        """
+        if self._parts is not None:
+            for part in self._parts.values():
+                part.add_attributes(attributes)
+            return
+        for att in attributes:
+            if not self.available(att):
+                print "Particle type {} has no {}, not added.".format(self._itype, att)
+            elif not att in self._att:
+                self._att += [att]
+
+    def available(self, att):
+        """
+            Does the snapshot have att for the particle type, as dataset
+            or as mass from the MassTable?
+        """
+        return self._meta.has_dataset(self._itype, att) or self.mass_table(att) is not None
+
+    def mass_table(self, att):
+        """
+            Mass of the particles from the MassTable of the header if att is
+            the Mass and the particles have no Mass dataset (dark matter),
+            None otherwise.
+        """
+        if att != 'Mass' or self._meta.has_dataset(self._itype, att):
+            return None
+        mass = self._meta.header('MassTable')[self._itype]
+        return mass if mass > 0 else None
+
+    def conversion(self, att):
+        """
+            Conversion factors (cgs, aexp, hexp) of att, for masses from the
+            MassTable the ones of the gas masses
+        """
+        if self.mass_table(att) is not None:
+            return self._meta.conversion(0, att)
+        return self._meta.conversion(self._itype, att)
+
+    def logged(self, att):
+        """
+            Are the values of att stored as log10? Only with precision
+            'log10' and only for floating point attributes other than the
+            Coordinates, integers like ParticleIDs are kept as they are.
+        """
+        if not self.single_type('logged'):
+            return False
+        if self._precision != 'log10' or att == 'Coordinates':
+            return False
+        return self.mass_table(att) is not None or self._meta.dtype(self._itype, att).kind == 'f'
+
+    def convert(self, att, tmp):
+        """
+            Convert the raw data tmp of attribute att to physical units
+            tmp is a fresh array of the selected particles, it is converted
+            in place unless precision 'f8' asks for a wider type.
+            The factors are kept in self._units, they are written to dumps.
+        """
+        if att == 'Coordinates':
+            self._units[att] = {'conversion': 1./self._h, 'units': 'cMpc'}
+            tmp /= self._h # Get co-moving coordinates
+            return tmp
+
+        cgs, aexp, hexp = self.conversion(att)
+        factor = cgs * self._a**aexp * self._h**hexp
+        self._units[att] = {'CGSConversionFactor': cgs, 'aexp-scale-exponent': aexp,
+                            'h-scale-exponent': hexp, 'conversion': factor, 'units': 'cgs'}
+
+        if self.logged(att):
+            # log10(x * factor) = log10(x) + log10(factor), can't overflow
+            self._units[att]['units'] = 'log10 cgs'
+            tmp = tmp.astype('f4', copy=False)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                np.log10(tmp, out=tmp)
+            tmp += np.float32(np.log10(factor))
+            return tmp
+
+        if self._precision == 'native' and factor == 1:
+            return tmp
+        if self._precision == 'native' and tmp.dtype.kind == 'f':
+            # e.g. masses in g exceed the range of float32
+            if tmp.size > 0 and np.abs(tmp).max() * factor > np.finfo(tmp.dtype).max:
+                print "{} in cgs exceeds the range of {}, using float64.".format(att, tmp.dtype)
+            else:
+                tmp *= factor
+                return tmp
+        if tmp.dtype == np.float64:
+            tmp *= factor
+            return tmp
+        return np.multiply(tmp, factor, dtype='f8')
+
+    def select(self, coords, grid=None):
+        """
+            Mask of the particles at coords that are within the filament region
+            (= in the volumes of self._volumes or the tubes around the segments)
+            grid: grid from make_grid to reuse, only for engine 'grid'
+        """
+        if self._engine == 'grid':
+            # Only test the volumes in the neighbouring cells of each particle
+            if grid is None:
+                grid = self.make_grid()
+            return grid.mask(coords)
 
-        # * Step 2 *
-        # Extract particles that are within the filament region
-        # (= in the volumes of self._volumes)
         def in_volume(pos):
             # For each volume around the centres, check if the position is contained
             # If yes, return True and if it is in no volume return False
@@ -178,30 +607,264 @@ class Filaments:
             return False
 
         # Apply `in_volume` to every single particle
-        mask = np.apply_along_axis(in_volume, axis=1, arr=data['Coordinates'])
+        return np.apply_along_axis(in_volume, axis=1, arr=coords).astype(bool).reshape(-1)
+
+    def mode(self):
+        """
+            How the particles are read:
+            'index'  -> cells of the particle index, see read_indexed
+            'region' -> region selected with read_eagle, see read_region
+            'stream' -> hyperslabs of the whole snapshot, see read_streaming
+        """
+        if self._pindex is not None:
+            return 'index'
+        return 'region' if self._max_memory is None else 'stream'
 
-        # Keep only those particles that are within the filament
-        for key in data.keys():
-            data[key] = data[key][mask]
+    def open_snapshot(self):
+        """
+            With particle_index: open the index of the snapshot.
+            Without max_memory: open the snapshot with read_eagle and select
+            only the region covered by the readout boxes.
+            With max_memory: open the snapshot with h5py and set the size of
+            the hyperslabs from self._max_memory, which bounds the working
+            memory (the selected particles come on top).
+        """
+        if self._particle_index:
+            if isinstance(self._particle_index, basestring):
+                self._pindex = ParticleIndex.open(self._dataloc, self._itype, self._particle_index)
+            else:
+                self._pindex = ParticleIndex.open(self._dataloc, self._itype)
+
+        if self.mode() == 'index':
+            self._reader = SnapshotReader(self._dataloc)
+        elif self.mode() == 'region':
+            # Selected before for another particle type?
+            if self._snapshot is None:
+                self.open_region()
+        else:
+            self._reader = SnapshotReader(self._dataloc)
+
+            # Half of the memory for the hyperslab and the per-particle bookkeeping
+            # of the grid query, the other half for the candidate pairs of the grid
+            row_bytes = self._reader.row_bytes(self._itype, self._att) + 8 * (len(self._att) + 2)
+            self._max_rows = max(1, int(self._max_memory // (2 * (row_bytes + QUERY_BYTES_PER_PARTICLE))))
+            self._max_pairs = max(1, int(self._max_memory // (2 * QUERY_BYTES_PER_PAIR)))
+            print "Streaming in hyperslabs of {} particles.".format(self._max_rows)
+
+    def open_region(self):
+        """
+            Open the snapshot with read_eagle and select the region covered
+            by the readout boxes, the same for all particle types.
+        """
+        # Initialize read_eagle module.
+        # Keep it, all attributes are read from the same selection
+        eagle_data = EagleSnapshot(self._dataloc)
+        self._snapshot = eagle_data
 
-        self._data = data
+        # The volumes are in cMpc, the snapshot in cMpc/h
+        eagle_cube_length = eagle_data.boxsize
+        print "EAGLE box size:", eagle_cube_length
+        # On the hash cells of the snapshot, which read_eagle reads whole
+        hashbits = self._meta.hash_bits()
+        if hashbits is None:
+            regions = covering_regions(self.readout_boxes()*self._h, eagle_cube_length)
+        else:
+            regions = covering_regions(self.readout_boxes()*self._h, eagle_cube_length, 2**hashbits, 1e-3)
+        for region in regions:
+            eagle_data.select_region(*region)
+        covered = np.prod(regions[:,1::2] - regions[:,0::2], axis=1).sum()/eagle_cube_length**3
+        print "Selected {} regions covering {:.1f}% of the box.".format(regions.shape[0], 100*covered)
+        print ""
+
+    def read_region(self):
+        """
+            Read the coordinates of all particles in the selected region
+            and set self._index to the ones within the volumes.
+            Returns the coordinates of the selected particles.
+        """
+
+        # * Step 1 *
+        # Read coordinates of all particles in the selected region
+        with self._profile.stage('read', self._itype) as stage:
+            coords = self._snapshot.read_dataset(self._itype, 'Coordinates')
+            stage.add(bytes_read=coords.nbytes)
+        with self._profile.stage('convert', self._itype):
+            coords = self.convert('Coordinates', coords)
+
+        # * Step 2 *
+        # Extract particles that are within the filament region
+        with self._profile.stage('select', self._itype) as stage:
+            if self._processes is not None and self._processes > 1 and \
+                    self._engine == 'grid' and self._selection == 'cube':
+                mask = parallel_select(coords, self._volumes, self._processes)
+            else:
+                mask = self.select(coords)
+            self._index = np.flatnonzero(mask)
+            stage.add(scanned=coords.shape[0], selected=self._index.size)
+
+        return coords[mask]
+
+    def read_indexed(self):
+        """
+            Read the coordinates of the particles in the cells of the
+            particle index touched by the readout boxes and set self._index
+            to the global indices of the ones within the volumes.
+            Returns the coordinates of the selected particles.
+        """
+        # The boxes are in cMpc, the snapshot in cMpc/h
+        with self._profile.stage('index', self._itype):
+            candidates = self._pindex.candidates(self.readout_boxes()*self._h)
+
+        with self._profile.stage('read', self._itype) as stage:
+            coords = self._reader.read_index(self._itype, 'Coordinates', candidates)
+            stage.add(bytes_read=coords.nbytes)
+        with self._profile.stage('convert', self._itype):
+            coords = self.convert('Coordinates', coords)
+
+        with self._profile.stage('select', self._itype) as stage:
+            mask = self.select(coords)
+            self._index = candidates[mask]
+            stage.add(scanned=coords.shape[0], selected=self._index.size)
+
+        return coords[mask]
+
+    def read_streaming(self):
+        """
+            Read the coordinates in hyperslabs and select per hyperslab,
+            only the selected ones are kept.
+            Sets self._index to the global indices of the selected particles
+            and returns their coordinates.
+        """
+
+        grid = self.make_grid(self._max_pairs) if self._engine == 'grid' else None
+
+        index, coords = [], []
+        for fname, start, stop, offset in self._reader.chunks(self._itype, self._max_rows):
+            with self._profile.stage('read', self._itype) as stage:
+                f = h5py.File(fname, 'r')
+                tmp = f['PartType%i/Coordinates'%self._itype][start:stop]
+                f.close()
+                stage.add(bytes_read=tmp.nbytes)
+            with self._profile.stage('convert', self._itype):
+                tmp = self.convert('Coordinates', tmp)
+
+            with self._profile.stage('select', self._itype) as stage:
+                mask = self.select(tmp, grid)
+                index.append(offset + np.flatnonzero(mask))
+                coords.append(tmp[mask])
+                stage.add(scanned=tmp.shape[0], selected=index[-1].size)
+
+        self._index = np.concatenate(index)
+        return np.concatenate(coords)
+
+    def distances(self):
+        """
+            Distance of each selected particle to the filament, computed once
+            for all particles and reused by scale:
+            cubes -> Chebyshev distance to the nearest centre
+            tubes -> distance to the nearest segment
+        """
+        if not self.single_type('distances'):
+            return
+        if self._distance is None:
+            self._distance = self.make_grid().distance(self._data['Coordinates'])
+        return self._distance
+
+    def membership(self):
+        """
+            Which selected particles belong to which centre (cubes) or
+            segment (tubes), as Membership, see membership.py.
+            Computed once from the coordinates of the selected particles.
+            The groups are the loaded centres in catalogue order or the
+            segments in the order of get_segments.
+        """
+        if not self.single_type('membership'):
+            return
+        if self._membership is None:
+            grid = self.make_grid()
+            particles, groups = grid.members(self._data['Coordinates'])
+            if self._selection == 'tube':
+                ngroups = self._segments[0].shape[0]
+            else:
+                ngroups = self._volumes.shape[0]
+            self._membership = Membership.from_pairs(particles, groups, ngroups)
+        return self._membership
+
+    def scale(self, box_length):
+        """
+            Particles within the smaller box length box_length around the
+            centres (or tube radius around the segments), taken from the
+            particles already selected, without reading the snapshot again.
+            Returns a FilamentScale, which can be plotted with the
+            Visualiser like a Filaments object.
+        """
+        if not self.single_type('scale'):
+            return
+        if not (box_length > 0 and box_length <= self._box_length):
+            print "Invalid box length, must be: 0 < box_length <= {}.".format(self._box_length)
+            return
+
+        return FilamentScale(self, self.distances() < box_length, box_length)
+
+    def scales(self, box_lengths):
+        """
+            Nested selections for all box lengths in box_lengths,
+            construct Filaments with the largest of them.
+        """
+        if not self.single_type('scales'):
+            return
+        return [self.scale(box_length) for box_length in box_lengths]
 
     def atts(self):
         return self._att
 
     def data(self):
+        """
+            Dictionary attribute -> values of the selected particles,
+            for several particle types dictionary type -> such dictionary
+        """
         return self._data
 
-    def dump(self, outfile):
-        self._dumper.dump(self._data, outfile)
-
-    def gather(self, files, outfile):
-        self._dumper.gather(files, outfile)
+    def dump(self, outfile, append=False):
+        """
+            Dump the selected particles, see filament_dump.py for the formats
+            append: append to an existing hdf5 dump, e.g. of another shard
+        """
+        if not self.single_type('dump'):
+            return
+        # Read all attributes that haven't been accessed yet
+        data = self._data.load(self._att)
+        header = {'Snapshot': self._dataloc, 'Time': self._a, 'HubbleParam': self._h,
+                  'BoxLength': self._box_length, 'PartType': self._itype}
+        with self._profile.stage('dump', self._itype):
+            self._dumper.dump(data, outfile, attrs=self._units, header=header, append=append)
+        self._profile.flush()
+
+    def gather(self, files, outfile, unique=None, virtual=False):
+        self._dumper.gather(files, outfile, unique=unique, virtual=virtual)
+
+    def histogram(self, att, lo=None, hi=None, nbins=50, weights=None):
+        """
+            Histogram of log10 of att, see histogram.py
+            lo, hi: range of the bins in log10, default: range of the values,
+                    set them to add up the histograms of several shards
+            weights: name of an attribute to weight with, e.g. 'Mass'
+        """
+        if not self.single_type('histogram'):
+            return
+        values = self._data[att]
+        if weights is not None:
+            weights = self.linear(weights)
+        if lo is None or hi is None:
+            return Histogram.from_values(att, values, nbins, weights, log=self.logged(att))
+        return Histogram(att, lo, hi, nbins).update(values, weights, log=self.logged(att))
 
     def hist(self, att='Density', title='', saveas='_hist.png'):
         """
             Plot histogram
         """
+        if not self.single_type('hist'):
+            return
 
         if not (att in self._att):
             print "Invalid attribute, didn't load this from the data."
@@ -210,7 +873,7 @@ class Filaments:
             return
 
         plt.figure()
-        plt.hist(np.log10(self._data[att]), bins=20)
+        self.histogram(att, nbins=20).plot()
         plt.minorticks_on()
         plt.title(title)
         plt.xlabel("log10" + att)
@@ -218,10 +881,47 @@ class Filaments:
         plt.savefig(att + saveas)
         plt.close()
 
-    def tempdensity(self):
+    def phase_diagram(self, weights=None, **kwargs):
+        """
+            Binned density--temperature phase diagram, see phase_diagram.py
+            weights: name of an attribute to weight with, e.g. 'Mass'
+            kwargs: ranges and number of bins, passed on to PhaseDiagram
+        """
+        if not self.single_type('phase_diagram'):
+            return
+        if weights is not None:
+            weights = self.linear(weights)
+        # log10 only matters for the sign of the star formation rate
+        sfr = self._data['StarFormationRate']
+        if self.logged('StarFormationRate'):
+            sfr = np.isfinite(sfr)
+        log = self.logged('Density')
+        if log != self.logged('Temperature'):
+            print "Density and Temperature must both be log10 or both not."
+            return
+        return PhaseDiagram(**kwargs).update(self._data['Density'], self._data['Temperature'],
+                                             sfr, weights, log=log)
+
+    def linear(self, att):
+        """
+            Values of att not in log10, e.g. to weight with
+        """
+        if not self.single_type('linear'):
+            return
+        values = self._data[att]
+        if not self.logged(att):
+            return values
+        if isinstance(values, ConstantColumn):
+            return ConstantColumn(10**float(values.value()), values.size, 'f8')
+        return 10**values.astype('f8')
+
+    def tempdensity(self, weights=None, saveas='PhaseDiagram_s12.png'):
         """
             Plot Temperature--Density relation.
+            weights: name of an attribute to weight with, e.g. 'Mass'
         """
+        if not self.single_type('tempdensity'):
+            return
         if not ('StarFormationRate' in self._att
                 and 'Density' in self._att
                 and 'Temperature' in self._att):
@@ -230,22 +930,34 @@ class Filaments:
             print self._att
             return
 
-        plt.figure()
+        # Currently star forming gas red, non star forming gas blue.
+        self.phase_diagram(weights).plot(saveas, show=True)
+
+class FilamentScale:
+    """
+        Particles of a Filaments object within a smaller box length around
+        the centres, see Filaments.scale
+    """
+    def __init__(self, filaments, mask, box_length):
+        """
+            filaments: Filaments object with a box length >= box_length
+            mask: which of the particles of filaments are within box_length
+        """
+        self._filaments = filaments
+        self._mask = mask
+        self._box_length = box_length
 
-        # Plot currently star forming gas red.
-        mask = np.where(self._data['StarFormationRate'] > 0)
-        plt.scatter(np.log10(self._data['Density'][mask]), np.log10(self._data['Temperature'][mask]),
-            c='red', s=3, edgecolor='none')
+        # Attributes are taken from filaments on first access
+        self._data = ParticleData(lambda att: filaments.data()[att][mask])
 
-        # Plot currently non star forming gas blue.
-        mask = np.where(self.gas['StarFormationRate'] == 0)
-        plt.scatter(np.log10(self._data['Density'][mask]), np.log10(self._data['Temperature'][mask]),
-            c='blue', s=3, edgecolor='none')
+    def box_length(self):
+        return self._box_length
 
-        # Save plot.
-        plt.minorticks_on()
-        plt.ylabel('log10 Temperature [K]'); plt.xlabel('log10 Density [g/cm**3]')
-        plt.tight_layout()
-        plt.savefig('PhaseDiagram_s12.png')
-        plt.show()
-        plt.close()
+    def atts(self):
+        return self._filaments.atts()
+
+    def logged(self, att):
+        return self._filaments.logged(att)
+
+    def data(self):
+        return self._data
@@ -0,0 +1,144 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+"""
+    Histogram of an attribute with fixed bins in log10 of the values.
+
+    It can be filled chunk by chunk, saved to a small file and histograms
+    with the same bins (e.g. from different shards of run.sh) can be added:
+
+        hist = Histogram('Density', -32, -22)
+        hist.update(fil.data()['Density'])
+        hist.save('density.0.npz')
+        ...
+        total = sum(Histogram.load(f) for f in files)
+        Visualiser().hist(total, 'Density')
+
+    Values outside of [lo, hi) are counted as underflow or overflow,
+    values <= 0 (no logarithm) are counted separately.
+    Values already in log10 (Filaments with precision 'log10') are binned
+    directly with log=True.
+"""
+
+class Histogram:
+
+    def __init__(self, att, lo, hi, nbins=50):
+        """
+            att: name of the attribute
+            lo, hi: range of log10 of the values
+            nbins: number of bins
+        """
+        self._att = att
+        self._edges = np.linspace(lo, hi, nbins + 1)
+        self._counts = np.zeros(nbins)
+        self._underflow = 0.
+        self._overflow = 0.
+        self._nonpositive = 0.
+
+    @classmethod
+    def from_values(cls, att, values, nbins=50, weights=None, log=False):
+        """
+            Histogram with the bins spanning the range of values
+        """
+        values = np.asarray(values)
+        if log:
+            logs = values[np.isfinite(values)]
+        else:
+            logs = np.log10(values[values > 0])
+        if logs.size == 0:
+            lo, hi = 0., 1.
+        else:
+            lo, hi = logs.min(), logs.max()
+            if lo == hi:
+                lo, hi = lo - 0.5, hi + 0.5
+            # Make sure the largest value is in the last bin
+            hi = np.nextafter(hi, np.inf)
+        hist = cls(att, lo, hi, nbins)
+        hist.update(values, weights, log)
+        return hist
+
+    def att(self):
+        return self._att
+
+    def edges(self):
+        return self._edges
+
+    def counts(self):
+        return self._counts
+
+    def total(self):
+        """
+            Sum of all counts including under-, overflow and values <= 0
+        """
+        return self._counts.sum() + self._underflow + self._overflow + self._nonpositive
+
+    def update(self, values, weights=None, log=False):
+        """
+            Add values (and weights, default 1 per value) to the histogram
+            log: values are log10 already, -inf or nan for values <= 0
+        """
+        values = np.asarray(values).ravel()
+        if weights is None:
+            weights = np.ones(values.size)
+        else:
+            weights = np.asarray(weights, dtype='f8').ravel()
+
+        if log:
+            positive = np.isfinite(values)
+        else:
+            positive = values > 0
+        self._nonpositive += weights[np.logical_not(positive)].sum()
+        logs = values[positive] if log else np.log10(values[positive])
+        weights = weights[positive]
+
+        # Bin index, -1 = underflow, nbins = overflow
+        nbins = self._counts.size
+        index = np.searchsorted(self._edges, logs, side='right') - 1
+        self._underflow += weights[index < 0].sum()
+        self._overflow += weights[index >= nbins].sum()
+        inside = (index >= 0) & (index < nbins)
+        self._counts += np.bincount(index[inside], weights=weights[inside], minlength=nbins)
+        return self
+
+    def __add__(self, other):
+        if not (self._att == other._att and np.array_equal(self._edges, other._edges)):
+            raise ValueError("Can only add histograms of the same attribute with the same bins.")
+        hist = Histogram(self._att, self._edges[0], self._edges[-1], self._counts.size)
+        hist._edges = self._edges.copy()
+        hist._counts = self._counts + other._counts
+        hist._underflow = self._underflow + other._underflow
+        hist._overflow = self._overflow + other._overflow
+        hist._nonpositive = self._nonpositive + other._nonpositive
+        return hist
+
+    def __radd__(self, other):
+        # Allows sum() over a list of histograms, which starts with 0
+        if other == 0:
+            return self
+        return self.__add__(other)
+
+    def save(self, fname):
+        np.savez(fname, att=self._att, edges=self._edges, counts=self._counts,
+                 outside=[self._underflow, self._overflow, self._nonpositive])
+
+    @classmethod
+    def load(cls, fname):
+        f = np.load(fname)
+        edges = f['edges']
+        hist = cls(str(f['att']), edges[0], edges[-1], edges.size - 1)
+        hist._edges = edges
+        hist._counts = f['counts']
+        hist._underflow, hist._overflow, hist._nonpositive = f['outside']
+        f.close()
+        return hist
+
+    def plot(self, label=None, normed=False):
+        """
+            Draw into the current figure like plt.hist(np.log10(values))
+        """
+        if normed and self._counts.sum() > 0:
+            # normalise to unit area
+            weights = self._counts/(self._counts.sum() * np.diff(self._edges))
+        else:
+            weights = self._counts
+        plt.hist(self._edges[:-1], bins=self._edges, weights=weights, label=label)
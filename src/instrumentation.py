@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import socket
+import atexit
+import resource
+
+"""
+    Wall time, bytes read, particles scanned and selected and peak memory of
+    the stages of Filaments (reading, unit conversion, selection, ...).
+
+    Off by default. Switched on with Filaments(..., profile='profile.jsonl')
+    or the environment variable FILAMENTS_PROFILE=profile.jsonl, '-' writes
+    to stdout. Each run (= Filaments object) appends json lines to the file:
+     - one line per stage (and particle type) with the accumulated values
+       of all calls: {"kind": "stage", "stage": "read", "seconds": ...}
+     - one line with the totals of the run: {"kind": "run", ...}
+    They are written at the end of the construction, after dumps and at
+    exit, with the values up to then. The runs of the shards of run.sh can
+    be compared by their totals, e.g. with catalogue_index and host.
+"""
+
+PROFILE_ENV = 'FILAMENTS_PROFILE'
+
+COUNTERS = ['bytes_read', 'scanned', 'selected']
+
+def peak_rss():
+    """
+        Peak resident memory [bytes] since the last reset_peak
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    # ru_maxrss is in kilobytes on Linux, can't be reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def reset_peak():
+    # Linux only, otherwise the peak of the whole process is reported
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+def make_profiler(profile=None, **info):
+    """
+        Profiler writing to profile, None: take it from the environment
+        variable FILAMENTS_PROFILE, False or '': switched off.
+        info: description of the run, written with the totals
+    """
+    if profile is None:
+        profile = os.environ.get(PROFILE_ENV)
+    if not profile:
+        return Profiler(None)
+    return Profiler(profile, **info)
+
+class Stage:
+    """
+        One call of a stage, created by Profiler.stage
+    """
+    def __init__(self, profiler, key):
+        self._profiler = profiler
+        self._key = key
+        self._counters = {}
+
+    def add(self, **counters):
+        """
+            Count e.g. bytes_read, scanned or selected particles
+        """
+        for name, value in counters.items():
+            self._counters[name] = self._counters.get(name, 0) + int(value)
+
+    def __enter__(self):
+        reset_peak()
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self._profiler.record(self._key, time.time() - self._start, peak_rss(), self._counters)
+        return False
+
+class NoStage:
+    """
+        Stage of a switched off profiler, does nothing
+    """
+    def add(self, **counters):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_STAGE = NoStage()
+
+class Profiler:
+
+    def __init__(self, outfile, **info):
+        """
+            outfile: json lines file to append to, '-' for stdout,
+                     None to switch off
+            info: description of the run, written with the totals
+        """
+        self._outfile = outfile
+        self._info = info
+        self._stages = {} # (stage, part type) -> accumulated values
+        self._updated = set() # stages to write with the next flush
+        if outfile is None:
+            return
+
+        self._run = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), int(1000*time.time()))
+        self._start = time.time()
+        atexit.register(self.flush)
+
+    def enabled(self):
+        return self._outfile is not None
+
+    def stage(self, name, part_type=None):
+        """
+            Context manager measuring a call of stage name:
+                with profiler.stage('read') as stage:
+                    data = ...
+                    stage.add(bytes_read=data.nbytes)
+        """
+        if self._outfile is None:
+            return NO_STAGE
+        return Stage(self, (name, part_type))
+
+    def record(self, key, seconds, peak, counters):
+        if not key in self._stages:
+            self._stages[key] = dict([('calls', 0), ('seconds', 0.), ('peak_rss', 0)] +
+                                     [(name, 0) for name in COUNTERS])
+        values = self._stages[key]
+        values['calls'] += 1
+        values['seconds'] += seconds
+        values['peak_rss'] = max(values['peak_rss'], peak)
+        for name, value in counters.items():
+            values[name] = values.get(name, 0) + value
+        self._updated.add(key)
+
+    def totals(self):
+        """
+            Values of the whole run: sum of the stages, peak_rss the
+            maximum, wall the time since the start
+        """
+        totals = dict((name, 0) for name in ['seconds'] + COUNTERS)
+        totals['peak_rss'] = 0
+        for values in self._stages.values():
+            for name, value in values.items():
+                if name == 'peak_rss':
+                    totals[name] = max(totals[name], value)
+                elif name != 'calls':
+                    totals[name] = totals.get(name, 0) + value
+        totals['wall'] = time.time() - self._start
+        return totals
+
+    def flush(self):
+        """
+            Write the stages updated since the last flush and the totals
+        """
+        if self._outfile is None or len(self._updated) == 0:
+            return
+
+        lines = []
+        for name, part_type in sorted(self._updated):
+            line = {'kind': 'stage', 'run': self._run, 'stage': name, 'part_type': part_type}
+            line.update(self._stages[(name, part_type)])
+            lines.append(line)
+        line = {'kind': 'run', 'run': self._run}
+        line.update(self._info)
+        line.update(self.totals())
+        lines.append(line)
+        self._updated = set()
+
+        text = ''.join(json.dumps(line, default=str) + '\n' for line in lines)
+        if self._outfile == '-':
+            sys.stdout.write(text)
+        else:
+            with open(self._outfile, 'a') as f:
+                f.write(text)
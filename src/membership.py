@@ -0,0 +1,111 @@
+import numpy as np
+
+"""
+    Which particles belong to which centre (or segment) of the filament.
+
+    A particle can be near several centres, so this is stored in compressed
+    sparse row form: the particles of group g are
+        indices[offsets[g]:offsets[g+1]]
+    where indices refer to the selected particles of a Filaments object,
+    i.e. to the rows of fil.data()[att].
+    All reductions work on all groups at once, e.g.
+        m = fil.membership()
+        m.mean(fil.data()['Density'])  # mean density around every centre
+"""
+
+class Membership:
+
+    def __init__(self, offsets, indices):
+        """
+            offsets: shape (ngroups + 1,), start of every group in indices
+            indices: particle indices sorted by group
+        """
+        self._offsets = np.asarray(offsets, dtype='i8')
+        self._indices = np.asarray(indices, dtype='i8')
+        # Group of every entry of indices
+        self._groups = np.repeat(np.arange(self.num_groups()), np.diff(self._offsets))
+
+    @classmethod
+    def from_pairs(cls, particles, groups, ngroups):
+        """
+            Build from pairs (particles[i], groups[i]) of particle and group
+            indices, there are ngroups groups.
+        """
+        order = np.lexsort((particles, groups))
+        counts = np.bincount(groups, minlength=ngroups)
+        offsets = np.zeros(ngroups + 1, dtype='i8')
+        np.cumsum(counts, out=offsets[1:])
+        return cls(offsets, np.asarray(particles)[order])
+
+    def num_groups(self):
+        return self._offsets.size - 1
+
+    def offsets(self):
+        return self._offsets
+
+    def indices(self):
+        return self._indices
+
+    def members(self, group):
+        """
+            Indices of the particles of group
+        """
+        return self._indices[self._offsets[group]:self._offsets[group+1]]
+
+    def count(self):
+        """
+            Number of particles of every group
+        """
+        return np.diff(self._offsets)
+
+    def sum(self, values, weights=None):
+        """
+            Sum of values (one per particle) of every group, optionally
+            weighted with weights (one per particle)
+        """
+        v = np.asarray(values)[self._indices]
+        if weights is not None:
+            v = v * np.asarray(weights)[self._indices]
+        return np.bincount(self._groups, weights=v, minlength=self.num_groups())
+
+    def mean(self, values, weights=None):
+        """
+            (Weighted) mean of values of every group, nan for empty groups
+        """
+        if weights is None:
+            norm = self.count().astype('f8')
+        else:
+            norm = self.sum(weights)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum(values, weights)/norm
+
+    def median(self, values, weights=None):
+        """
+            (Weighted) median of values of every group, nan for empty groups.
+            The weighted median is the smallest value for which the weights
+            of all values up to it add up to at least half of the total.
+        """
+        v = np.asarray(values)[self._indices]
+        if weights is None:
+            w = np.ones(v.size)
+        else:
+            w = np.asarray(weights, dtype='f8')[self._indices]
+
+        # Sort by value within every group
+        order = np.lexsort((v, self._groups))
+        v, w, g = v[order], w[order], self._groups[order]
+
+        # Cumulative weight within the group
+        cumulative = np.cumsum(w)
+        before = np.concatenate([[0.], cumulative])[self._offsets[:-1]]
+        within = cumulative - before[g]
+        total = np.bincount(g, weights=w, minlength=self.num_groups())
+
+        # First value per group reaching half of the total weight
+        reached = np.flatnonzero(within >= 0.5*total[g])
+        groups, first = np.unique(g[reached], return_index=True)
+
+        median = np.empty(self.num_groups())
+        median.fill(np.nan)
+        median[groups] = v[reached[first]]
+        return median
@@ -0,0 +1,52 @@
+import numpy as np
+from multiprocessing import Pool, RawArray
+
+from spatial_index import CentreGrid
+
+"""
+    Selection of the particles in the readout volumes with a pool of processes.
+
+    The coordinates are copied once into shared memory, which the worker
+    processes get when they are started. The volumes are split into shards,
+    each worker builds the cell grid over the volumes of its shard and returns
+    the indices of the particles within them. The indices of all shards are
+    merged into one mask, so particles in overlapping volumes of different
+    shards are only counted once.
+"""
+
+# Coordinates in shared memory, set in every worker by _init_worker
+_coords = None
+
+def _init_worker(shared, n):
+    global _coords
+    _coords = np.frombuffer(shared, dtype='f8').reshape((n, 3))
+
+def _select_shard(volumes):
+    return np.flatnonzero(CentreGrid(volumes).mask(_coords))
+
+def parallel_select(coords, volumes, processes, shard_size=None):
+    """
+        Mask of the particles at coords (shape (n, 3)) within the volumes
+        (shape (nvolumes, 6)), the same as CentreGrid(volumes).mask(coords).
+        processes: number of worker processes
+        shard_size: number of volumes per task, default splits the volumes
+                    evenly over the processes
+    """
+    n = coords.shape[0]
+    if shard_size is None:
+        shard_size = max(1, int(np.ceil(volumes.shape[0]/float(processes))))
+    shards = [volumes[i:i+shard_size] for i in range(0, volumes.shape[0], shard_size)]
+
+    shared = RawArray('d', 3*n)
+    np.frombuffer(shared, dtype='f8')[:] = np.asarray(coords, dtype='f8').ravel()
+
+    pool = Pool(processes, initializer=_init_worker, initargs=(shared, n))
+    try:
+        mask = np.zeros(n, dtype=bool)
+        for index in pool.imap_unordered(_select_shard, shards):
+            mask[index] = True
+    finally:
+        pool.close()
+        pool.join()
+
+    return mask
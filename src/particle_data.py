@@ -0,0 +1,31 @@
+"""
+    Dictionary of particle attributes which are read on first access.
+
+    Filaments only reads the coordinates of all particles to find the ones
+    near the filament, every other attribute is read for the selected
+    particles only, once it is used for the first time, e.g. by
+        fil.data()['Density']
+"""
+
+class ParticleData(dict):
+
+    def __init__(self, loader):
+        """
+            loader: function att -> array of att for the selected particles
+        """
+        dict.__init__(self)
+        self._loader = loader
+
+    def __missing__(self, att):
+        # Called by d[att] if att has not been read yet
+        value = self._loader(att)
+        self[att] = value
+        return value
+
+    def load(self, atts):
+        """
+            Make sure all attributes in atts are read
+        """
+        for att in atts:
+            self[att]
+        return self
@@ -0,0 +1,136 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import h5py
+
+from snapshot_metadata import SnapshotMetadata, CACHE_DIR
+from snapshot_reader import SnapshotReader
+from spatial_index import occupied_cells, merge_ranges
+
+"""
+    Persistent index of the particles of a snapshot by cell, built once per
+    snapshot and particle type (see build_index.py) and memory-mapped on use.
+
+    The box is divided into ncells**3 cells, cell (ix, iy, iz) has the key
+    (ix*ncells + iy)*ncells + iz. The index is a directory with
+        permutation.npy global indices of the particles sorted by key,
+                        i.e. the permutation sorting the particles by cell
+        offsets.npy     the particles of cell k are
+                        permutation[offsets[k]:offsets[k+1]]
+        index.json      snapshot, the modification times of its files,
+                        particle type, ncells, box size
+    in CACHE_DIR (see snapshot_metadata.py) or another directory, the index
+    takes 8 bytes per particle.
+
+    Filaments(..., particle_index=True) then reads only the particles in the
+    cells touched by the readout boxes instead of all coordinates.
+"""
+
+def index_path(dataloc, itype, directory=CACHE_DIR):
+    name = hashlib.sha1(os.path.abspath(dataloc).encode('utf-8')).hexdigest()
+    return os.path.join(directory, '{}.PartType{}.index'.format(name, itype))
+
+def file_mtimes(dataloc):
+    """
+        Modification times of all files of the snapshot dataloc
+    """
+    return [os.path.getmtime(fname) for fname in SnapshotMetadata.get(dataloc).files()]
+
+class ParticleIndex:
+
+    @classmethod
+    def build(cls, dataloc, itype, ncells=64, directory=CACHE_DIR, max_rows=2**22):
+        """
+            Build the index of the particles of type itype of the snapshot
+            dataloc, the coordinates are read in hyperslabs of max_rows.
+            directory: where to write the index, e.g. a scratch disk for
+                       large snapshots
+            Returns the path of the index.
+        """
+        reader = SnapshotReader(dataloc)
+        meta = SnapshotMetadata.get(dataloc)
+        boxsize = meta.header('BoxSize')
+        cell = float(boxsize)/ncells
+
+        keys = np.empty(int(reader.num_part(itype).sum()), dtype='i8')
+        for fname, start, stop, offset in reader.chunks(itype, max_rows):
+            with h5py.File(fname, 'r') as f:
+                pos = f['PartType%i/Coordinates'%itype][start:stop]
+            ijk = np.clip(np.floor(pos/cell).astype('i8'), 0, ncells - 1)
+            keys[offset:offset + stop - start] = (ijk[:,0]*ncells + ijk[:,1])*ncells + ijk[:,2]
+
+        # The sorted keys themselves are not needed, the offsets tell
+        # which cell every entry of the permutation belongs to
+        permutation = np.argsort(keys, kind='mergesort')
+        offsets = np.zeros(ncells**3 + 1, dtype='i8')
+        np.cumsum(np.bincount(keys, minlength=ncells**3), out=offsets[1:])
+        del keys
+
+        # Write to a temporary directory first, other processes never see
+        # a partially written index
+        path = index_path(dataloc, itype, directory)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, 'permutation.npy'), permutation)
+        np.save(os.path.join(tmp, 'offsets.npy'), offsets)
+        info = {'snapshot': os.path.abspath(dataloc), 'mtimes': file_mtimes(dataloc),
+                'part_type': itype, 'ncells': ncells, 'boxsize': boxsize}
+        with open(os.path.join(tmp, 'index.json'), 'w') as f:
+            json.dump(info, f)
+
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp, path)
+        return path
+
+    @classmethod
+    def open(cls, dataloc, itype, directory=CACHE_DIR):
+        """
+            Index of the snapshot dataloc for particle type itype in
+            directory, None if there is none or if it is out of date, i.e.
+            any file of the snapshot was modified after it was built.
+        """
+        path = index_path(dataloc, itype, directory)
+        if not os.path.isdir(path):
+            print "No particle index for", dataloc, "PartType{}, build it with build_index.py.".format(itype)
+            return None
+        index = cls(path)
+        if index.info().get('mtimes') != file_mtimes(dataloc):
+            print "Particle index of", dataloc, "is out of date, build it again with build_index.py."
+            return None
+        return index
+
+    def __init__(self, path):
+        self._path = path
+        with open(os.path.join(path, 'index.json'), 'r') as f:
+            self._info = json.load(f)
+        self._permutation = np.load(os.path.join(path, 'permutation.npy'), mmap_mode='r')
+        self._offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+
+    def info(self):
+        return self._info
+
+    def permutation(self):
+        return self._permutation
+
+    def offsets(self):
+        return self._offsets
+
+    def candidates(self, volumes):
+        """
+            Sorted global indices of the particles in all cells touched by
+            the volumes (in the units of the snapshot, clipped to the box).
+            Consecutive cells are one slice of the permutation.
+        """
+        cells = np.flatnonzero(occupied_cells(volumes, self._info['boxsize'], self._info['ncells']))
+        starts, stops = merge_ranges(self._offsets[cells], self._offsets[cells + 1])
+
+        index = np.empty(int((stops - starts).sum()), dtype='i8')
+        pos = 0
+        for start, stop in zip(starts, stops):
+            index[pos:pos + stop - start] = self._permutation[start:stop]
+            pos += stop - start
+        index.sort()
+        return index
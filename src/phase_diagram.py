@@ -0,0 +1,129 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+"""
+    Density--temperature phase diagram binned on a fixed grid in
+    log10 density [g/cm**3] and log10 temperature [K].
+
+    Star forming (StarFormationRate > 0) and non star forming gas are counted
+    in separate layers. Like the histograms (see histogram.py) a phase
+    diagram can be filled chunk by chunk, saved and added up across shards:
+
+        pd = PhaseDiagram()
+        pd.update(data['Density'], data['Temperature'], data['StarFormationRate'])
+        total = sum(PhaseDiagram.load(f) for f in files)
+        total.plot('PhaseDiagram.png')
+"""
+
+LAYERS = ['starforming', 'nonstarforming']
+
+class PhaseDiagram:
+
+    def __init__(self, density_range=(-32., -22.), temperature_range=(2., 8.), nbins=(200, 200)):
+        """
+            density_range: range of log10 density
+            temperature_range: range of log10 temperature
+            nbins: number of bins in density and temperature
+        """
+        self._xedges = np.linspace(density_range[0], density_range[1], nbins[0] + 1)
+        self._yedges = np.linspace(temperature_range[0], temperature_range[1], nbins[1] + 1)
+        self._counts = dict((layer, np.zeros(nbins)) for layer in LAYERS)
+        # Particles outside of the grid (or with density/temperature <= 0)
+        self._outside = 0.
+
+    def edges(self):
+        return self._xedges, self._yedges
+
+    def counts(self, layer):
+        """
+            2d array of the counts of layer, shape (ndensity, ntemperature)
+        """
+        return self._counts[layer]
+
+    def update(self, density, temperature, sfr, weights=None, log=False):
+        """
+            Add particles with density, temperature and star formation rate
+            sfr, weighted by weights (e.g. the mass) if given.
+            log: density and temperature are log10 already
+        """
+        density = np.asarray(density).ravel()
+        temperature = np.asarray(temperature).ravel()
+        if weights is None:
+            weights = np.ones(density.size)
+        else:
+            weights = np.asarray(weights, dtype='f8').ravel()
+
+        nx, ny = self._xedges.size - 1, self._yedges.size - 1
+        if log:
+            valid = np.isfinite(density) & np.isfinite(temperature)
+            logdensity, logtemperature = density[valid], temperature[valid]
+        else:
+            valid = (density > 0) & (temperature > 0)
+            logdensity, logtemperature = np.log10(density[valid]), np.log10(temperature[valid])
+        ix = np.full(density.size, -1, dtype='i8')
+        iy = np.full(density.size, -1, dtype='i8')
+        ix[valid] = np.searchsorted(self._xedges, logdensity, side='right') - 1
+        iy[valid] = np.searchsorted(self._yedges, logtemperature, side='right') - 1
+
+        inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        self._outside += weights[np.logical_not(inside)].sum()
+
+        starforming = np.asarray(sfr).ravel() > 0
+        for layer, mask in zip(LAYERS, [starforming, np.logical_not(starforming)]):
+            sel = inside & mask
+            binned = np.bincount(ix[sel]*ny + iy[sel], weights=weights[sel], minlength=nx*ny)
+            self._counts[layer] += binned.reshape((nx, ny))
+        return self
+
+    def __add__(self, other):
+        if not (np.array_equal(self._xedges, other._xedges) and np.array_equal(self._yedges, other._yedges)):
+            raise ValueError("Can only add phase diagrams with the same bins.")
+        pd = PhaseDiagram((self._xedges[0], self._xedges[-1]), (self._yedges[0], self._yedges[-1]),
+                          (self._xedges.size - 1, self._yedges.size - 1))
+        pd._xedges, pd._yedges = self._xedges.copy(), self._yedges.copy()
+        for layer in LAYERS:
+            pd._counts[layer] = self._counts[layer] + other._counts[layer]
+        pd._outside = self._outside + other._outside
+        return pd
+
+    def __radd__(self, other):
+        # Allows sum() over a list of phase diagrams, which starts with 0
+        if other == 0:
+            return self
+        return self.__add__(other)
+
+    def save(self, fname):
+        np.savez(fname, xedges=self._xedges, yedges=self._yedges, outside=self._outside,
+                 **self._counts)
+
+    @classmethod
+    def load(cls, fname):
+        f = np.load(fname)
+        pd = cls((0., 1.), (0., 1.), (1, 1))
+        pd._xedges, pd._yedges = f['xedges'], f['yedges']
+        pd._counts = dict((layer, f[layer]) for layer in LAYERS)
+        pd._outside = float(f['outside'])
+        f.close()
+        return pd
+
+    def plot(self, saveas='PhaseDiagram.png', show=False):
+        """
+            Plot both layers, star forming gas red and non star forming gas
+            blue (as the scatter plots before), colour = log10 of the counts.
+        """
+        plt.figure()
+        for layer, cmap in zip(['nonstarforming', 'starforming'], ['Blues', 'Reds']):
+            counts = self._counts[layer]
+            if not counts.any():
+                continue
+            image = np.ma.masked_less_equal(counts, 0)
+            # Transpose: x = density, y = temperature
+            plt.pcolormesh(self._xedges, self._yedges, np.ma.log10(image).T, cmap=cmap)
+
+        plt.minorticks_on()
+        plt.ylabel('log10 Temperature [K]'); plt.xlabel('log10 Density [g/cm**3]')
+        plt.tight_layout()
+        plt.savefig(saveas)
+        if show:
+            plt.show()
+        plt.close()
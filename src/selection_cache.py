@@ -0,0 +1,84 @@
+import os
+import hashlib
+import numpy as np
+
+"""
+    On-disk cache of particle selections.
+
+    A selection (the indices of the particles near the filament) is stored as
+    <directory>/<key>.npy, where key is a hash of everything the selection
+    depends on (see Filaments.selection_key). Reading an entry updates its
+    modification time, so the least recently used entries are the ones with
+    the oldest modification time and are removed first once the cache grows
+    larger than max_bytes.
+"""
+
+class SelectionCache:
+
+    def __init__(self, directory, max_bytes=2**30):
+        """
+            directory: where to store the selections, created if necessary
+            max_bytes: maximal total size of the cache
+        """
+        self._dir = directory
+        self._max_bytes = max_bytes
+
+        if not os.path.isdir(self._dir):
+            os.makedirs(self._dir)
+
+    def key(self, *parts):
+        """
+            Hash of the string representation of parts
+        """
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._dir, key + '.npy')
+
+    def get(self, key):
+        """
+            Stored selection or None if there is none for key
+        """
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+
+        # Mark as recently used
+        os.utime(path, None)
+        return np.load(path)
+
+    def put(self, key, index):
+        """
+            Store the selection index under key
+        """
+        # Write to a temporary file first, so other processes never see
+        # a partially written selection
+        path = self._path(key)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, index)
+        os.rename(tmp, path)
+
+        self.evict()
+
+    def evict(self):
+        """
+            Remove least recently used selections until the cache is smaller
+            than max_bytes
+        """
+        entries = []
+        for name in os.listdir(self._dir):
+            if name.endswith('.npy'):
+                stat = os.stat(os.path.join(self._dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self._dir, name))
+            except OSError:
+                # Removed by another process in the meantime
+                pass
+            total -= size
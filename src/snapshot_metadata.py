@@ -0,0 +1,169 @@
+import os
+import json
+import hashlib
+import numpy as np
+import h5py
+
+"""
+    Metadata of an EAGLE snapshot, read once and shared.
+
+    Everything the tools need besides the particle data itself:
+     - the attributes of the Header group (Time, HubbleParam, BoxSize, ...)
+     - the number of particles of each type in each file of the snapshot
+     - for each dataset PartTypeN/<att> in any file: the conversion factors
+       (CGSConversionFactor, aexp-scale-exponent, h-scale-exponent),
+       the data type and the shape of one row
+     - the HashBits of the hash tables (None without hash tables)
+
+    SnapshotMetadata.get(dataloc) returns the same object for the same
+    snapshot within a process. Across processes the metadata is cached in
+    CACHE_DIR (environment variable FILAMENTS_CACHE, default
+    ~/.cache/filaments) as json, renewed if any file of the snapshot is
+    modified.
+"""
+
+CACHE_DIR = os.environ.get('FILAMENTS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'filaments'))
+
+CONVERSION_ATTRS = ['CGSConversionFactor', 'aexp-scale-exponent', 'h-scale-exponent']
+
+def _plain(value):
+    # numpy values to python values, for json
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return value
+
+class SnapshotMetadata:
+
+    # One instance per snapshot within a process
+    _instances = {}
+
+    @classmethod
+    def get(cls, dataloc, cache_dir=CACHE_DIR):
+        """
+            Metadata of the snapshot dataloc (any file of the snapshot)
+        """
+        key = os.path.abspath(dataloc)
+        if not key in cls._instances:
+            cls._instances[key] = cls(dataloc, cache_dir)
+        return cls._instances[key]
+
+    def __init__(self, dataloc, cache_dir=CACHE_DIR):
+        self._dataloc = dataloc
+        self._base = dataloc.rsplit('.', 2)[0]
+
+        cached = None
+        if cache_dir is not None:
+            name = hashlib.sha1(os.path.abspath(dataloc).encode('utf-8')).hexdigest() + '.json'
+            cached = os.path.join(cache_dir, name)
+            if os.path.isfile(cached):
+                with open(cached, 'r') as f:
+                    meta = json.load(f)
+                if self.up_to_date(meta):
+                    self._meta = meta
+                    return
+
+        self._meta = self.read()
+
+        if cached is not None:
+            try:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                tmp = '{}.{}.tmp'.format(cached, os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump(self._meta, f)
+                os.rename(tmp, cached)
+            except (IOError, OSError):
+                # Not cached on disk then, but still within the process
+                pass
+
+    def up_to_date(self, meta):
+        """
+            Is the cached metadata meta from the current files of the
+            snapshot? Only their modification times are looked at.
+        """
+        if not 'mtimes' in meta:
+            return False
+        try:
+            return [os.path.getmtime(fname) for fname in meta['files']] == meta['mtimes']
+        except OSError:
+            return False
+
+    def read(self):
+        """
+            Read the metadata from the snapshot files
+            The datasets are collected from all files, a file without
+            particles of some type has no group of this type.
+        """
+        meta = {'header': {}, 'datasets': {}}
+
+        with h5py.File(self._dataloc, 'r') as f:
+            for name, value in f['Header'].attrs.items():
+                meta['header'][name] = _plain(value)
+            hashbits = f['HashTable'].attrs.get('HashBits') if 'HashTable' in f else None
+            meta['hashbits'] = None if hashbits is None else int(hashbits)
+
+        def visit(name, obj):
+            if isinstance(obj, h5py.Dataset) and name.startswith('PartType') and not name in meta['datasets']:
+                info = dict((att, _plain(obj.attrs.get(att))) for att in CONVERSION_ATTRS)
+                info['dtype'] = obj.dtype.str
+                info['shape'] = list(obj.shape[1:])
+                meta['datasets'][name] = info
+
+        # Number of particles and datasets in every file of the snapshot
+        nfiles = int(meta['header'].get('NumFilesPerSnapshot', 1))
+        meta['files'] = ['{}.{}.hdf5'.format(self._base, i) for i in range(nfiles)]
+        meta['mtimes'] = [os.path.getmtime(fname) for fname in meta['files']]
+        meta['numpart'] = []
+        for fname in meta['files']:
+            with h5py.File(fname, 'r') as f:
+                meta['numpart'].append(_plain(f['Header'].attrs.get('NumPart_ThisFile')))
+                f.visititems(visit)
+
+        return meta
+
+    def header(self, name):
+        """
+            Attribute name of the Header group
+        """
+        return self._meta['header'].get(name)
+
+    def header_info(self):
+        """
+            Scale factor, h and box size [Mpc/h]
+        """
+        return self.header('Time'), self.header('HubbleParam'), self.header('BoxSize')
+
+    def files(self):
+        return self._meta['files']
+
+    def hash_bits(self):
+        """
+            HashBits of the hash tables, None if the snapshot has none
+        """
+        return self._meta['hashbits']
+
+    def num_part(self, itype):
+        """
+            Number of particles of type itype in each file
+        """
+        return np.array(self._meta['numpart'], dtype='i8').reshape((-1, 6))[:,itype]
+
+    def has_dataset(self, itype, att):
+        return 'PartType%i/%s'%(itype, att) in self._meta['datasets']
+
+    def conversion(self, itype, att):
+        """
+            (CGSConversionFactor, aexp-scale-exponent, h-scale-exponent)
+            of the dataset PartType<itype>/<att>
+        """
+        info = self._meta['datasets']['PartType%i/%s'%(itype, att)]
+        return tuple(info[name] for name in CONVERSION_ATTRS)
+
+    def dtype(self, itype, att):
+        return np.dtype(str(self._meta['datasets']['PartType%i/%s'%(itype, att)]['dtype']))
+
+    def row_shape(self, itype, att):
+        """
+            Shape of the data of one particle, () for scalars, (3,) for vectors
+        """
+        return tuple(self._meta['datasets']['PartType%i/%s'%(itype, att)]['shape'])
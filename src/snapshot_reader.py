@@ -0,0 +1,119 @@
+import numpy as np
+import h5py
+
+from snapshot_metadata import SnapshotMetadata
+
+"""
+    Plain h5py access to the files of an EAGLE snapshot.
+
+    A snapshot is split into several files
+        /path/to/snap_012_z003p017.0.hdf5
+        /path/to/snap_012_z003p017.1.hdf5
+        ...
+    and the number of files is stored in the header (NumFilesPerSnapshot).
+    The particles of a type are numbered globally in the order of the files,
+    i.e. the particles of file 1 follow the ones of file 0 and so on.
+"""
+
+class SnapshotReader:
+
+    def __init__(self, dataloc):
+        """
+            dataloc: location of any file of the snapshot, e.g. the one
+                     given in the header of the filament catalogue
+        """
+        self._dataloc = dataloc
+
+        # File names and particle numbers, see snapshot_metadata.py
+        self._meta = SnapshotMetadata.get(dataloc)
+        self._files = self._meta.files()
+
+    def files(self):
+        return self._files
+
+    def num_part(self, itype):
+        """
+            Number of particles of type itype in each file
+        """
+        return self._meta.num_part(itype)
+
+    def row_bytes(self, itype, atts):
+        """
+            Number of bytes of one particle for the attributes atts
+            in the native data type of the snapshot.
+        """
+        nbytes = 0
+        for att in atts:
+            if not self._meta.has_dataset(itype, att):
+                continue # e.g. masses of dark matter, from the MassTable
+            nbytes += self._meta.dtype(itype, att).itemsize * int(np.prod(self._meta.row_shape(itype, att)))
+        return nbytes
+
+    def chunks(self, itype, max_rows):
+        """
+            Generator over hyperslabs of at most max_rows particles.
+            Yields (fname, start, stop, offset) where [start, stop) is the
+            row range within file fname and offset the global index of
+            the particle in row start.
+        """
+        offset = 0
+        for fname, n in zip(self._files, self.num_part(itype)):
+            for start in range(0, n, max_rows):
+                stop = min(start + max_rows, n)
+                yield fname, start, stop, offset + start
+            offset += n
+
+    def read_rows(self, itype, att, index, max_rows):
+        """
+            Read attribute att of the particles with global indices index
+            (sorted, as returned by np.flatnonzero), in hyperslabs of at most
+            max_rows particles. Hyperslabs without any of the particles are
+            skipped.
+        """
+        index = np.asarray(index)
+        parts = []
+        f, current = None, None
+        for fname, start, stop, offset in self.chunks(itype, max_rows):
+            lo, hi = np.searchsorted(index, [offset, offset + stop - start])
+            if lo == hi:
+                continue
+            if fname != current:
+                if f is not None:
+                    f.close()
+                f, current = h5py.File(fname, 'r'), fname
+            tmp = f['PartType%i/%s'%(itype, att)][start:stop]
+            parts.append(tmp[index[lo:hi] - offset])
+        if f is not None:
+            f.close()
+
+        if len(parts) > 0:
+            return np.concatenate(parts)
+        return np.empty((0,) + self._meta.row_shape(itype, att), dtype=self._meta.dtype(itype, att))
+
+    def read_index(self, itype, att, index, max_gap=1024):
+        """
+            Read attribute att of the particles with global indices index
+            (sorted), rows closer than max_gap to each other are read with
+            one hyperslab, so only the rows around the particles are read.
+        """
+        index = np.asarray(index, dtype='i8')
+        out = np.empty((index.size,) + self._meta.row_shape(itype, att), dtype=self._meta.dtype(itype, att))
+
+        # Global index of the first particle of every file
+        bounds = np.concatenate([[0], np.cumsum(self.num_part(itype))])
+        split = np.searchsorted(index, bounds)
+        for i, fname in enumerate(self._files):
+            lo, hi = split[i], split[i+1]
+            if lo == hi:
+                continue
+            rows = index[lo:hi] - bounds[i]
+
+            # Runs of rows without larger gaps
+            gaps = np.flatnonzero(np.diff(rows) > max_gap) + 1
+            starts, stops = np.append(0, gaps), np.append(gaps, rows.size)
+            with h5py.File(fname, 'r') as f:
+                dset = f['PartType%i/%s'%(itype, att)]
+                for a, b in zip(starts, stops):
+                    tmp = dset[rows[a]:rows[b-1]+1]
+                    out[lo+a:lo+b] = tmp[rows[a:b] - rows[a]]
+        return out
@@ -0,0 +1,480 @@
+import numpy as np
+
+"""
+    Uniform cell grid over the readout volumes of the filament centres.
+
+    Every volume [xmin, xmax, ymin, ymax, zmin, zmax] is filed under the grid
+    cell that contains its lower corner (xmin, ymin, zmin). The cell size is
+    the largest edge length of all volumes, so a volume that contains a
+    particle must have its lower corner either in the particle's own cell or
+    in the cell directly below it along each axis. Hence only 2**3 = 8 cells
+    have to be looked at per particle instead of every single volume.
+
+    The test of the candidate volumes is exactly the one of
+    Filaments.read_particles, i.e. vol[0] < x < vol[1] and so on, so the
+    resulting mask is the same as with the brute force loop.
+"""
+
+# Offsets of the cells that might contain the lower corner of a volume
+# containing a particle: all combinations of -1 and 0 along each axis
+NEIGHBOURS = np.array([[i, j, k] for i in (-1, 0) for j in (-1, 0) for k in (-1, 0)])
+
+# A cell and all cells around it: all combinations of -1, 0 and 1
+SURROUNDING = np.array([[i, j, k] for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)])
+
+# Rough memory needed by a query: per queried particle (neighbour cells,
+# their keys and volume ranges) and per candidate pair (indices, positions
+# and volumes of the pair)
+QUERY_BYTES_PER_PARTICLE = 512
+QUERY_BYTES_PER_PAIR = 104
+
+def box_cells(lo, hi):
+    """
+        All cells (i, j, k) with lo <= (i, j, k) <= hi of every box,
+        lo, hi: integer cell indices of the corners, shape (nboxes, 3)
+        Returns the index of the box of every cell and the cells.
+    """
+    extent = hi - lo + 1
+    ncells = np.prod(extent, axis=1)
+    box = np.repeat(np.arange(ncells.size), ncells)
+    local = np.arange(ncells.sum()) - np.repeat(np.cumsum(ncells) - ncells, ncells)
+    ext = extent[box]
+    cells = lo[box].copy()
+    cells[:,2] += local % ext[:,2]
+    cells[:,1] += (local // ext[:,2]) % ext[:,1]
+    cells[:,0] += local // (ext[:,2] * ext[:,1])
+    return box, cells
+
+def candidate_pairs(pidx, start, counts, order, max_pairs):
+    """
+        Expand ranges of sorted items into (particle, item) pairs.
+        pidx: indices of the particles, shape (n,)
+        start, counts: the items of particle pidx[i] in cell j are
+                       order[start[i,j]:start[i,j]+counts[i,j]], shape (n, ncells)
+        Yields (pidx, items) in blocks of about max_pairs pairs.
+    """
+    # Split the particles such that there are no more than max_pairs
+    # candidates per block
+    per_particle = counts.sum(axis=1)
+    block = np.cumsum(per_particle) // max_pairs
+    bounds = np.flatnonzero(np.diff(block)) + 1
+    for sl in np.split(np.arange(pidx.size), bounds):
+        if sl.size == 0:
+            continue
+        c = counts[sl].ravel()
+        s = start[sl].ravel()
+        total = c.sum()
+        if total == 0:
+            continue
+        # Position within the sorted items of every candidate
+        first = np.repeat(np.cumsum(c) - c, c)
+        pos = np.arange(total) - first + np.repeat(s, c)
+        yield np.repeat(pidx[sl], per_particle[sl]), order[pos]
+
+class CentreGrid:
+
+    def __init__(self, volumes, max_pairs=2**22):
+        """
+            volumes: 2d array of shape (nvolumes, 6) as set by
+                     Filaments.get_readout_volumes
+            max_pairs: maximal number of (particle, volume) candidate pairs
+                       tested at once, bounds the memory of a query
+        """
+        self._volumes = np.asarray(volumes, dtype='f8').reshape((-1, 6))
+        self._max_pairs = max_pairs
+        if self.num_volumes() == 0:
+            self._cell = 1.
+            self._origin = np.zeros(3)
+            self._shape = np.ones(3, dtype='i8')
+            self._keys = np.empty(0, dtype='i8')
+            self._order = np.empty(0, dtype='i8')
+            return
+
+        lower = self._volumes[:,0::2]
+        upper = self._volumes[:,1::2]
+
+        # Cell size = largest edge of all volumes (at least 1 cell per volume)
+        self._cell = np.max(upper - lower)
+        self._origin = lower.min(axis=0)
+        self._shape = np.floor((lower.max(axis=0) - self._origin)/self._cell).astype('i8') + 1
+
+        # Sort the volumes by the key of the cell of their lower corner,
+        # the volumes in a cell are then self._order[start:stop]
+        keys = self._key(self._cell_index(lower))
+        self._order = np.argsort(keys, kind='mergesort')
+        self._keys = keys[self._order]
+
+    def _cell_index(self, pos):
+        return np.floor((pos - self._origin)/self._cell).astype('i8')
+
+    def _key(self, ijk):
+        return (ijk[...,0]*self._shape[1] + ijk[...,1])*self._shape[2] + ijk[...,2]
+
+    def num_volumes(self):
+        return self._volumes.shape[0]
+
+    def pairs(self, pos):
+        """
+            Generator over the candidate pairs of particles and volumes.
+            Yields (pidx, vidx) where pidx are indices into pos and vidx
+            indices into the volumes. The particles in pos[pidx] are not
+            necessarily in the volumes[vidx], this still has to be checked.
+            At most max_pairs pairs are yielded at once (unless a single
+            particle has more candidates than that).
+        """
+        pos = np.asarray(pos).reshape((-1, 3))
+        if pos.shape[0] == 0 or self.num_volumes() == 0:
+            return
+
+        # Particles outside of [0, shape] in any direction cannot be in a volume
+        ijk = self._cell_index(pos)
+        inside = np.all((ijk >= 0) & (ijk <= self._shape), axis=1)
+        pidx = np.flatnonzero(inside)
+        ijk = ijk[pidx]
+
+        # Cells to look at for each particle, shape (nparticles, 8, 3)
+        cells = ijk[:,None,:] + NEIGHBOURS[None,:,:]
+        valid = np.all((cells >= 0) & (cells < self._shape), axis=2)
+        keys = self._key(cells)
+
+        # Range of volumes in each of these cells
+        start = np.searchsorted(self._keys, keys, side='left')
+        stop = np.searchsorted(self._keys, keys, side='right')
+        counts = np.where(valid, stop - start, 0)
+
+        for pairs in candidate_pairs(pidx, start, counts, self._order, self._max_pairs):
+            yield pairs
+
+    def contains(self, pos, pidx, vidx):
+        """
+            Which of the pairs (pos[pidx], volumes[vidx]) are contained?
+            Same comparison as the brute force `in_volume` test.
+        """
+        p = pos[pidx]
+        v = self._volumes[vidx]
+        return ((v[:,0] < p[:,0]) & (p[:,0] < v[:,1]) &
+                (v[:,2] < p[:,1]) & (p[:,1] < v[:,3]) &
+                (v[:,4] < p[:,2]) & (p[:,2] < v[:,5]))
+
+    def mask(self, pos):
+        """
+            Boolean mask of the particles at positions pos (shape (n, 3))
+            that are within at least one of the volumes.
+        """
+        pos = np.asarray(pos).reshape((-1, 3))
+        mask = np.zeros(pos.shape[0], dtype=bool)
+        for pidx, vidx in self.pairs(pos):
+            mask[pidx[self.contains(pos, pidx, vidx)]] = True
+        return mask
+
+    def members(self, pos):
+        """
+            All pairs (pidx, vidx) of particles pos[pidx] within volumes vidx
+        """
+        pos = np.asarray(pos).reshape((-1, 3))
+        particles, volumes = [np.empty(0, dtype='i8')], [np.empty(0, dtype='i8')]
+        for pidx, vidx in self.pairs(pos):
+            inside = self.contains(pos, pidx, vidx)
+            particles.append(pidx[inside])
+            volumes.append(vidx[inside])
+        return np.concatenate(particles), np.concatenate(volumes)
+
+    def distance(self, pos):
+        """
+            Smallest Chebyshev distance max(|x - cx|, |y - cy|, |z - cz|) of
+            the particles at positions pos to the centre c of any volume
+            containing them, np.inf for particles outside of all volumes.
+            A particle is within a cube of half edge length l < volume size
+            around a centre if its distance is smaller than l.
+        """
+        pos = np.asarray(pos).reshape((-1, 3))
+        dist = np.empty(pos.shape[0])
+        dist.fill(np.inf)
+        centres = 0.5*(self._volumes[:,0::2] + self._volumes[:,1::2])
+        for pidx, vidx in self.pairs(pos):
+            inside = self.contains(pos, pidx, vidx)
+            pidx, vidx = pidx[inside], vidx[inside]
+            d = np.abs(pos[pidx] - centres[vidx]).max(axis=1)
+            # Largest distances first: for particles appearing several times
+            # the last assignment, i.e. the smallest distance, wins
+            order = np.argsort(d)[::-1]
+            pidx, d = pidx[order], d[order]
+            dist[pidx] = np.minimum(dist[pidx], d)
+        return dist
+
+class SegmentGrid:
+    """
+        Uniform cell grid over the segments between consecutive centres of
+        the filament skeleton, to find the particles within distance radius
+        of the skeleton (a tube around the filament).
+
+        Every segment is filed under all cells the tube around it passes
+        through. A particle can then only be within radius of the segments
+        filed under its own cell. The cell size is 2 * radius.
+
+        The cells are found by walking along the segment: points spaced at
+        most one cell apart are placed on it, every point within radius of
+        the segment is then at most one cell away from one of them along
+        each axis. Of the cells around these points only the ones whose
+        centre is closer than (1 + sqrt(3)) * radius to the segment are
+        kept, the others cannot contain a point within radius. A segment of
+        length l is thus filed under O(l / radius) cells, not under all
+        O((l / radius)**3) cells of its bounding box.
+    """
+
+    def __init__(self, starts, ends, radius, max_pairs=2**22):
+        """
+            starts, ends: end points of the segments, shape (nsegments, 3),
+                          a segment with start == end is a sphere
+            radius: radius of the tube
+            max_pairs: maximal number of (particle, segment) candidate pairs
+                       tested at once, bounds the memory of a query
+        """
+        self._starts = np.asarray(starts, dtype='f8').reshape((-1, 3))
+        self._ends = np.asarray(ends, dtype='f8').reshape((-1, 3))
+        self._radius = float(radius)
+        self._max_pairs = max_pairs
+
+        self._cell = 2*self._radius
+        if self.num_segments() == 0:
+            self._origin = np.zeros(3)
+            self._shape = np.ones(3, dtype='i8')
+            self._keys = np.empty(0, dtype='i8')
+            self._order = np.empty(0, dtype='i8')
+            return
+
+        lower = np.minimum(self._starts, self._ends) - self._radius
+        upper = np.maximum(self._starts, self._ends) + self._radius
+        self._origin = lower.min(axis=0)
+        self._shape = self._cell_index(upper).max(axis=0) + 1
+
+        # Points along every segment, at most one cell apart (both ends included)
+        length = np.sqrt(((self._ends - self._starts)**2).sum(axis=1))
+        npoints = np.ceil(length/self._cell).astype('i8') + 1
+        seg = np.repeat(np.arange(npoints.size), npoints)
+        step = np.arange(npoints.sum()) - np.repeat(np.cumsum(npoints) - npoints, npoints)
+        t = step/np.maximum(npoints[seg] - 1, 1).astype('f8')
+
+        # Cells around the points close enough to the segment, in blocks
+        # of about max_pairs cells, each (cell, segment) filed once
+        keys, segs = [], []
+        nseg = self.num_segments()
+        block = max(1, self._max_pairs // SURROUNDING.shape[0])
+        for first in range(0, seg.size, block):
+            s, tt = seg[first:first+block], t[first:first+block]
+            points = self._starts[s] + tt[:,None]*(self._ends[s] - self._starts[s])
+            cells = self._cell_index(points)[:,None,:] + SURROUNDING[None,:,:]
+            s = np.repeat(s, SURROUNDING.shape[0])
+            cells = cells.reshape((-1, 3))
+            valid = np.all((cells >= 0) & (cells < self._shape), axis=1)
+            s, cells = s[valid], cells[valid]
+            pairs = np.unique(self._key(cells)*nseg + s)
+            s, key = pairs % nseg, pairs // nseg
+            centres = self._origin + (self._cell_coords(key) + 0.5)*self._cell
+            near = self.squared_distance(centres, np.arange(s.size), s) < ((1 + np.sqrt(3))*self._radius)**2
+            keys.append(key[near])
+            segs.append(s[near])
+        pairs = np.unique(np.concatenate(keys)*nseg + np.concatenate(segs))
+
+        # Sorted by cell, the segments in a cell are then self._order[start:stop]
+        self._keys = pairs // nseg
+        self._order = pairs % nseg
+
+    def _cell_index(self, pos):
+        return np.floor((pos - self._origin)/self._cell).astype('i8')
+
+    def _key(self, ijk):
+        return (ijk[...,0]*self._shape[1] + ijk[...,1])*self._shape[2] + ijk[...,2]
+
+    def _cell_coords(self, key):
+        ijk = np.empty(key.shape + (3,), dtype='i8')
+        ijk[...,2] = key % self._shape[2]
+        ijk[...,1] = (key // self._shape[2]) % self._shape[1]
+        ijk[...,0] = key // (self._shape[2] * self._shape[1])
+        return ijk
+
+    def num_segments(self):
+        return self._starts.shape[0]
+
+    def num_entries(self):
+        """
+            Number of (cell, segment) entries of the grid
+        """
+        return self._keys.size
+
+    def boxes(self):
+        """
+            Boxes of all cells with segments, shape (ncells, 6) like the
+            readout volumes. Together they contain the tubes.
+        """
+        lower = self._origin + self._cell_coords(np.unique(self._keys))*self._cell
+        boxes = np.empty((lower.shape[0], 6))
+        boxes[:,0::2] = lower
+        boxes[:,1::2] = lower + self._cell
+        return boxes
+
+    def pairs(self, pos):
+        """
+            Generator over the candidate pairs (pidx, sidx) of particles
+            pos[pidx] and segments sidx, see CentreGrid.pairs
+        """
+        pos = np.asarray(pos).reshape((-1, 3))
+        if pos.shape[0] == 0 or self.num_segments() == 0:
+            return
+
+        ijk = self._cell_index(pos)
+        inside = np.all((ijk >= 0) & (ijk < self._shape), axis=1)
+        pidx = np.flatnonzero(inside)
+        keys = self._key(ijk[pidx])[:,None]
+
+        start = np.searchsorted(self._keys, keys, side='left')
+        stop = np.searchsorted(self._keys, keys, side='right')
+        for pairs in candidate_pairs(pidx, start, stop - start, self._order, self._max_pairs):
+            yield pairs
+
+    def squared_distance(self, pos, pidx, sidx):
+        """
+            Squared distance of the particles pos[pidx] to the segments sidx
+        """
+        p = pos[pidx]
+        a = self._starts[sidx]
+        d = self._ends[sidx] - a
+        dd = np.einsum('ij,ij->i', d, d)
+        # Parameter of the closest point a + t*d on the segment
+        t = np.einsum('ij,ij->i', p - a, d)/np.where(dd > 0, dd, 1)
+        t = np.clip(t, 0, 1)
+        r = p - a - t[:,None]*d
+        return np.einsum('ij,ij->i', r, r)
+
+    def mask(self, pos):
+        """
+            Boolean mask of the particles at positions pos (shape (n, 3))
+            closer than radius to at least one segment.
+        """
+        pos = np.asarray(pos).reshape((-1, 3))
+        mask = np.zeros(pos.shape[0], dtype=bool)
+        for pidx, sidx in self.pairs(pos):
+            mask[pidx[self.squared_distance(pos, pidx, sidx) < self._radius**2]] = True
+        return mask
+
+    def members(self, pos):
+        """
+            All pairs (pidx, sidx) of particles pos[pidx] closer than radius
+            to segments sidx
+        """
+        pos = np.asarray(pos).reshape((-1, 3))
+        particles, segments = [np.empty(0, dtype='i8')], [np.empty(0, dtype='i8')]
+        for pidx, sidx in self.pairs(pos):
+            inside = self.squared_distance(pos, pidx, sidx) < self._radius**2
+            particles.append(pidx[inside])
+            segments.append(sidx[inside])
+        return np.concatenate(particles), np.concatenate(segments)
+
+    def distance(self, pos):
+        """
+            Distance of the particles at positions pos to the nearest
+            segment, np.inf for particles farther away than radius.
+        """
+        pos = np.asarray(pos).reshape((-1, 3))
+        dist = np.empty(pos.shape[0])
+        dist.fill(np.inf)
+        for pidx, sidx in self.pairs(pos):
+            d = self.squared_distance(pos, pidx, sidx)
+            inside = d < self._radius**2
+            pidx, d = pidx[inside], np.sqrt(d[inside])
+            # Largest distances first, the smallest one is assigned last
+            order = np.argsort(d)[::-1]
+            pidx, d = pidx[order], d[order]
+            dist[pidx] = np.minimum(dist[pidx], d)
+        return dist
+
+def occupied_cells(volumes, boxsize, ncells=64):
+    """
+        Cells of a grid of ncells**3 cells over the box [0, boxsize]**3 that
+        are touched by any of the volumes, boolean array (ncells, ncells, ncells)
+        The volumes are clipped to the box, there are no periodic images.
+    """
+    volumes = np.asarray(volumes, dtype='f8').reshape((-1, 6))
+    cell = float(boxsize)/ncells
+
+    lo = np.clip(np.floor(volumes[:,0::2]/cell).astype('i8'), 0, ncells - 1)
+    hi = np.clip(np.floor(volumes[:,1::2]/cell).astype('i8'), 0, ncells - 1)
+
+    occupied = np.zeros((ncells, ncells, ncells), dtype=bool)
+    # Small volumes (e.g. the cells of a SegmentGrid) all at once,
+    # large ones by slicing
+    small = np.prod(hi - lo + 1, axis=1) <= 64
+    slo, shi = lo[small], hi[small]
+    for first in range(0, slo.shape[0], 2**16):
+        box, cells = box_cells(slo[first:first+2**16], shi[first:first+2**16])
+        occupied[cells[:,0], cells[:,1], cells[:,2]] = True
+    for l, h in zip(lo[~small], hi[~small]):
+        occupied[l[0]:h[0]+1, l[1]:h[1]+1, l[2]:h[2]+1] = True
+    return occupied
+
+def merge_ranges(starts, stops):
+    """
+        Merge the sorted ranges [starts[i], stops[i]) that touch each other,
+        empty ranges are dropped
+    """
+    keep = stops > starts
+    starts, stops = starts[keep], stops[keep]
+    if starts.size == 0:
+        return starts, stops
+    first = np.ones(starts.size, dtype=bool)
+    first[1:] = starts[1:] != stops[:-1]
+    last = np.append(first[1:], True)
+    return starts[first], stops[last]
+
+def covering_regions(volumes, boxsize, ncells=64, inset=0.):
+    """
+        Compact set of regions covering the union of the volumes.
+
+        The box [0, boxsize]**3 is divided into ncells**3 cells (the
+        hash cells of the snapshot if ncells = 2**HashBits), every cell
+        touched by a volume is marked and the marked cells are merged into
+        boxes: first into runs along z, then runs with the same extent in
+        neighbouring y columns are joined.
+
+        volumes: 2d array of shape (nvolumes, 6), same units as boxsize
+        Returns 2d array of shape (nregions, 6), rows are
+        [xmin, xmax, ymin, ymax, zmin, zmax] as expected by select_region.
+        The volumes are clipped to the box, there are no periodic images.
+        inset: fraction of a cell the edges of the regions are pulled into
+               their cells. read_eagle selects every hash cell a region
+               touches, a region ending exactly on a cell boundary would
+               also select the next layer of cells. Only for regions on
+               the hash cells, readers testing the coordinates of the
+               particles would miss the ones in the inset.
+    """
+    cell = float(boxsize)/ncells
+    occupied = occupied_cells(volumes, boxsize, ncells)
+    if not occupied.any():
+        return np.empty((0, 6))
+
+    # Runs of marked cells along z: rising and falling edges
+    padded = np.zeros((ncells, ncells, ncells + 2), dtype='i1')
+    padded[:,:,1:-1] = occupied
+    edges = np.diff(padded, axis=2)
+    ix, iy, z0 = np.nonzero(edges == 1)
+    z1 = np.nonzero(edges == -1)[2]
+
+    # Join runs with the same (x, z0, z1) in consecutive y columns
+    order = np.lexsort((iy, z1, z0, ix))
+    ix, iy, z0, z1 = ix[order], iy[order], z0[order], z1[order]
+    new = np.ones(ix.size, dtype=bool)
+    new[1:] = ((ix[1:] != ix[:-1]) | (z0[1:] != z0[:-1]) |
+               (z1[1:] != z1[:-1]) | (iy[1:] != iy[:-1] + 1))
+    first = np.flatnonzero(new)
+    last = np.append(first[1:], ix.size) - 1
+
+    regions = np.empty((first.size, 6))
+    regions[:,0] = ix[first]
+    regions[:,1] = ix[first] + 1
+    regions[:,2] = iy[first]
+    regions[:,3] = iy[last] + 1
+    regions[:,4] = z0[first]
+    regions[:,5] = z1[first]
+    regions[:,0::2] += inset
+    regions[:,1::2] -= inset
+    return regions*cell
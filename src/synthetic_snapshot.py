@@ -0,0 +1,210 @@
+import numpy as np
+import h5py
+
+from eagle_snapshot import peano_hilbert_keys
+
+"""
+    Synthetic EAGLE-like snapshots and filament catalogues, for tests and
+    benchmarks without the EAGLE data.
+
+    The snapshot has the layout read by Filaments and the legacy readers:
+        prefix.0.hdf5, prefix.1.hdf5, ...
+        Header: Time, Redshift, HubbleParam, BoxSize, MassTable,
+                NumPart_ThisFile, NumPart_Total, NumPart_Total_HighWord,
+                NumFilesPerSnapshot
+        PartType0/<att>: gas, Coordinates, Velocity, Density, Temperature,
+                         StarFormationRate, Mass, ParticleIDs
+        PartType1/<att>: dark matter, Coordinates, Velocity, ParticleIDs,
+                         the mass is in the MassTable
+        HashTable: particles per Peano--Hilbert cell, see eagle_snapshot.py
+    Every dataset carries CGSConversionFactor, aexp-scale-exponent and
+    h-scale-exponent as in EAGLE.
+
+    Part of the particles is placed along a few random filaments, the
+    catalogue (see catalogue_reader.py for the format) samples the same
+    filaments, so selections around the centres aren't empty:
+
+        make_snapshot('/tmp/snap', 10**6)
+        make_catalogue('/tmp/snap.csv', '/tmp/snap', 1000)
+"""
+
+# Values of the EAGLE reference model at z = 3
+HUBBLE = 0.6777
+TIME = 0.2489
+BOXSIZE = 12.5 * HUBBLE # [cMpc/h]
+DM_MASS = 6.57e-4 # [1e10 Msun/h]
+GAS_MASS = 1.2e-4 # [1e10 Msun/h]
+
+# Conversion factors (CGSConversionFactor, aexp-scale-exponent, h-scale-exponent)
+CONVERSION = {
+    'Coordinates':       (3.085678e24, 1., -1.),
+    'Velocity':          (1e5, 0.5, 0.),
+    'Density':           (6.769911e-31, -3., 2.),
+    'Temperature':       (1., 0., 0.),
+    'StarFormationRate': (6.30257e25, 0., 0.),
+    'Mass':              (1.989e43, 0., -1.),
+    'ParticleIDs':       (1., 0., 0.),
+}
+
+def filament_spines(nfilaments, npoints, boxsize, rng):
+    """
+        Random walks through the box as the skeleton of the filaments,
+        shape (nfilaments, npoints, 3), in the units of boxsize.
+    """
+    start = rng.uniform(0, boxsize, (nfilaments, 1, 3))
+    direction = rng.normal(size=(nfilaments, 1, 3))
+    direction /= np.sqrt((direction**2).sum(axis=2))[:,:,None]
+
+    # Steps along a slowly turning direction
+    step = 0.5*boxsize/npoints
+    turns = np.cumsum(rng.normal(scale=0.1, size=(nfilaments, npoints, 3)), axis=1)
+    steps = direction + turns
+    steps *= step/np.sqrt((steps**2).sum(axis=2))[:,:,None]
+    return (start + np.cumsum(steps, axis=1)) % boxsize
+
+def positions(n, spines, boxsize, rng, fraction=0.5, width=None):
+    """
+        n positions, fraction of them scattered around the spines with a
+        width of 1% of the box, the others uniform in the box
+    """
+    if width is None:
+        width = 0.01*boxsize
+    near = rng.uniform(size=n) < fraction
+    pos = rng.uniform(0, boxsize, (n, 3))
+
+    points = spines.reshape((-1, 3))
+    which = rng.randint(0, points.shape[0], np.count_nonzero(near))
+    pos[near] = points[which] + rng.normal(scale=width, size=(which.size, 3))
+    return pos % boxsize
+
+def write_dataset(group, att, data):
+    dset = group.create_dataset(att, data=data)
+    cgs, aexp, hexp = CONVERSION[att]
+    dset.attrs['CGSConversionFactor'] = cgs
+    dset.attrs['aexp-scale-exponent'] = aexp
+    dset.attrs['h-scale-exponent'] = hexp
+
+def hash_table(pos, bits, nfiles):
+    """
+        Sort the positions by the key of their cell (see eagle_snapshot.py)
+        and split them into nfiles files of consecutive keys.
+        Returns the sorted positions, the rows of the files (file i has the
+        rows [rows[i], rows[i+1])), the first and last key of every file and
+        the number of particles per key of every file.
+    """
+    ncells = 2**bits
+    ijk = np.clip(np.floor(pos/BOXSIZE*ncells).astype('i8'), 0, ncells - 1)
+    keys = peano_hilbert_keys(ijk[:,0], ijk[:,1], ijk[:,2], bits)
+    order = np.argsort(keys, kind='mergesort')
+    keys, pos = keys[order], pos[order]
+
+    # Files start at the keys of equally spaced particles
+    firstkey = np.zeros(nfiles, dtype='i8')
+    if keys.size > 0:
+        firstkey[1:] = keys[(np.arange(1, nfiles)*keys.size)//nfiles]
+    # At least one key per file
+    firstkey = np.maximum.accumulate(firstkey - np.arange(nfiles)) + np.arange(nfiles)
+    lastkey = np.append(firstkey[1:] - 1, ncells**3 - 1)
+    rows = np.append(np.searchsorted(keys, firstkey), keys.size)
+
+    counts = []
+    for i in range(nfiles):
+        counts.append(np.bincount(keys[rows[i]:rows[i+1]] - firstkey[i], minlength=lastkey[i] - firstkey[i] + 1))
+    return pos, rows, firstkey, lastkey, counts
+
+def make_snapshot(prefix, nparticles, nfiles=4, nfilaments=20, seed=0, hash_bits=6):
+    """
+        Write the snapshot prefix.<i>.hdf5, i = 0, ..., nfiles-1, with
+        nparticles gas and nparticles dark matter particles.
+        hash_bits: the particles are sorted by the Peano--Hilbert key of
+                   their cell with 2**hash_bits cells per dimension and the
+                   hash tables are written as in EAGLE, None: no hash
+                   tables, particles in random order
+        Only the coordinates of all particles are in memory at once, the
+        other attributes are made file by file.
+        Returns the location of the first file.
+    """
+    rng = np.random.RandomState(seed)
+    spines = filament_spines(nfilaments, 100, BOXSIZE, rng)
+
+    # Coordinates and the rows of every file for both types
+    pos, rows, tables = {}, {}, {}
+    for itype in (0, 1):
+        pos[itype] = positions(nparticles, spines, BOXSIZE, rng)
+        if hash_bits is None:
+            rows[itype] = np.linspace(0, nparticles, nfiles + 1).astype('i8')
+        else:
+            pos[itype], rows[itype], first, last, counts = hash_table(pos[itype], hash_bits, nfiles)
+            tables[itype] = (first, last, counts)
+
+    for i in range(nfiles):
+        n = [rows[itype][i+1] - rows[itype][i] for itype in (0, 1)]
+        with h5py.File('{}.{}.hdf5'.format(prefix, i), 'w') as f:
+            header = f.create_group('Header')
+            header.attrs['Time'] = TIME
+            header.attrs['Redshift'] = 1./TIME - 1
+            header.attrs['HubbleParam'] = HUBBLE
+            header.attrs['BoxSize'] = BOXSIZE
+            header.attrs['MassTable'] = np.array([0., DM_MASS, 0., 0., 0., 0.])
+            header.attrs['NumPart_ThisFile'] = np.array(n + [0, 0, 0, 0], dtype='i4')
+            header.attrs['NumPart_Total'] = np.array([nparticles, nparticles, 0, 0, 0, 0], dtype='u4')
+            header.attrs['NumPart_Total_HighWord'] = np.zeros(6, dtype='u4')
+            header.attrs['NumFilesPerSnapshot'] = nfiles
+
+            ids = np.arange(rows[0][i], rows[0][i+1], dtype='i8')
+            gas = f.create_group('PartType0')
+            write_dataset(gas, 'Coordinates', pos[0][rows[0][i]:rows[0][i+1]])
+            write_dataset(gas, 'Velocity', rng.normal(scale=200., size=(n[0], 3)).astype('f4'))
+            write_dataset(gas, 'Density', rng.lognormal(0., 2., n[0]).astype('f4'))
+            write_dataset(gas, 'Temperature', rng.lognormal(np.log(1e4), 1., n[0]).astype('f4'))
+            sfr = np.where(rng.uniform(size=n[0]) < 0.05, rng.exponential(1e-26, n[0]), 0.)
+            write_dataset(gas, 'StarFormationRate', sfr.astype('f4'))
+            write_dataset(gas, 'Mass', np.full(n[0], GAS_MASS, dtype='f4'))
+            write_dataset(gas, 'ParticleIDs', 2*ids)
+
+            ids = np.arange(rows[1][i], rows[1][i+1], dtype='i8')
+            dm = f.create_group('PartType1')
+            write_dataset(dm, 'Coordinates', pos[1][rows[1][i]:rows[1][i+1]])
+            write_dataset(dm, 'Velocity', rng.normal(scale=200., size=(n[1], 3)).astype('f4'))
+            write_dataset(dm, 'ParticleIDs', 2*ids + 1)
+
+            if hash_bits is not None:
+                table = f.create_group('HashTable')
+                table.attrs['HashBits'] = hash_bits
+                for itype, (first, last, counts) in tables.items():
+                    group = table.create_group('PartType%i'%itype)
+                    group.create_dataset('FirstKeyInFile', data=first)
+                    group.create_dataset('LastKeyInFile', data=last)
+                    group.create_dataset('NumParticleInCell', data=counts[i].astype('i4'))
+
+    # The filaments are taken from the same random numbers in make_catalogue
+    return '{}.0.hdf5'.format(prefix)
+
+def make_catalogue(fname, prefix, ncentres, nfilaments=20, seed=0):
+    """
+        Write a filament catalogue with ncentres centres sampling the
+        filaments of the snapshot prefix (made with the same nfilaments
+        and seed), coordinates in cMpc.
+    """
+    rng = np.random.RandomState(seed)
+    spines = filament_spines(nfilaments, 100, BOXSIZE, rng)
+
+    points = spines.reshape((-1, 3))
+    centres = points[np.linspace(0, points.shape[0] - 1, ncentres).astype('i8')]/HUBBLE
+
+    # Same numbers of particles as in the snapshot
+    with h5py.File('{}.0.hdf5'.format(prefix), 'r') as f:
+        nparticles = int(f['Header'].attrs.get('NumPart_Total')[0])
+
+    columns = np.empty((ncentres, 5))
+    columns[:,0] = rng.uniform(1., 10., ncentres)  # persistence_ratio
+    columns[:,1] = rng.uniform(0., 6., ncentres)   # persistence_nsigmas
+    columns[:,2:] = centres
+
+    header = '\n'.join(['# {}.0.hdf5'.format(prefix),
+                        '# {}'.format(BOXSIZE/HUBBLE),
+                        '# {}'.format(nparticles),
+                        '# Synthetic filaments, see synthetic_snapshot.py',
+                        '"persistence_ratio","persistence_nsigmas","coords:0","coords:1","coords:2"'])
+    np.savetxt(fname, columns, delimiter=',', header=header, comments='')
+    return fname
@@ -1,13 +1,16 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
+from histogram import Histogram
+
 class Visualiser:
     def __init__(self):
         pass
 
     def hist(self, filaments, att, title="", labels="Data", saveas="_hist.png"):
         """
-            filaments: Instance of class Filaments or list of it
+            filaments: Instance of class Filaments or Histogram or list of them
+                       (Histograms e.g. added up from the shards of run.sh)
             att: attribute to plot
         """
         plt.figure()
@@ -18,24 +21,20 @@ class Visualiser:
                 # TODO do a fix
 
             for l, f in zip(labels, filaments):
-                # Attribute check
-                if not (att in f.atts()):
-                    print f, "does not contain the requested attribute."
-                    print "Available attributes:"
-                    print f.atts()
+                hist = self.histogram(f, att)
+                if hist is None:
                     print "Skipping this filament for plotting."
+                    continue
 
-                plt.hist(np.log10(f.data()[att]), bins=50, label=l, normed=True)
+                hist.plot(label=l, normed=True)
 
         else:
-            if not (att in filaments.atts()):
-                print "Filaments object does not contain the requested attribute."
-                print "Available attributes:"
-                print f.atts()
+            hist = self.histogram(filaments, att)
+            if hist is None:
                 plt.close()
                 return
 
-            plt.hist(np.log10(filaments.data()[att]), bins=50, label=labels, normed=True)
+            hist.plot(label=labels, normed=True)
 
         plt.legend(loc="best")
         plt.minorticks_on()
@@ -44,3 +43,26 @@ class Visualiser:
         plt.tight_layout()
         plt.savefig(att + saveas)
         plt.close()
+
+    def histogram(self, filaments, att, nbins=50):
+        """
+            Histogram of att, filaments is a Histogram already or a
+            Filaments object (or anything else with atts() and data())
+            Returns None if att is not available.
+        """
+        if isinstance(filaments, Histogram):
+            if filaments.att() != att:
+                print "Histogram is of", filaments.att(), "not of", att
+                return None
+            return filaments
+
+        # Attribute check
+        if not (att in filaments.atts()):
+            print filaments, "does not contain the requested attribute."
+            print "Available attributes:"
+            print filaments.atts()
+            return None
+
+        # Filaments with precision 'log10' store log10 of the values
+        log = hasattr(filaments, 'logged') and filaments.logged(att)
+        return Histogram.from_values(att, filaments.data()[att], nbins, log=log)